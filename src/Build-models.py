@@ -1,27 +1,39 @@
 #!/usr/bin/env python3
 
 import logging
-from sys import argv
+import argparse
 from Classifier import regData
 from configData import configData
+from modelUpdate import get_model_history, get_new_batch, update_model
 import pickle
 
-from dataInterface import read_features, load_molcounts_data
+from dataInterface import read_features, load_molcounts_data, write_model_regions, load_model_bundle, read_model_regions, \
+    write_model_history, read_model_history
 
 """
 Only build model with the input full data and dump with pickle
+With --update, the model at model_prefix is updated with the new batch at update_count_path instead;
+a full build on count_path is done when the batch drifts more than drift_max_shift,
+or when the model has no training summary to update (see modelUpdate.get_loss_kind)
 """
 
-def main():
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.INFO)
 
-    config_path = argv[1]
-    config_data = configData(config_path)
+def write_bundle(output_prefix, trained_model, scale_model, pca_model, regions, history):
+    for suffix, pcontent in [("predictor", trained_model), ("scaler", scale_model), ("transformer", pca_model)]:
+        outpath = output_prefix + "." + suffix + ".pkl"
+        outfile = open(outpath, 'wb')
+        pickle.dump(pcontent, outfile)
+        outfile.close()
 
-    features = read_features(config_data.feature_path, config_data.bad_cohorts, config_data.bad_batches)
-    logging.info("Read %d samples with features.", features.shape[0])
-    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, config_data.cancer_type, config_data.maf_key)
+    # regions used by the model: prediction only needs to load these
+    write_model_regions(output_prefix, regions)
+    # training summary in reduced space, for incremental updates
+    write_model_history(output_prefix, history)
+
+
+def build_full(config_data, features):
+    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, config_data.cancer_type, config_data.maf_key,
+                                                use_cache=getattr(config_data, "count_cache", False))
     logging.info("Loaded %d %s/normal data in %d regions.", mcm_data.shape[0], config_data.cancer_type, len(raw_regions))
 
     # manually change some reg_data params
@@ -33,25 +45,63 @@ def main():
     reg_data.run_training()
     logging.info("Training completed.")
 
-    outpath = config_data.output_prefix + ".predictor.pkl"
-    outfile = open(outpath, 'wb')
-    pickle.dump(reg_data.trained_model, outfile)
-    outfile.close()
-
-    outpath = config_data.output_prefix + ".scaler.pkl"
-    outfile = open(outpath, 'wb')
-    pickle.dump(reg_data.scale_model, outfile)
-    outfile.close()
-
-    outpath = config_data.output_prefix + ".transformer.pkl"
-    outfile = open(outpath, 'wb')
-    pickle.dump(reg_data.pca_model, outfile)
-    outfile.close()
+    write_bundle(config_data.output_prefix, reg_data.trained_model, reg_data.scale_model, reg_data.pca_model,
+                 reg_data.model_regions, get_model_history(reg_data))
 
     # for diagnostic
     outpath = config_data.output_prefix + ".training_roc.tsv"
     reg_data.get_roc(rtype="train").to_csv(outpath, sep='\t', index=False)
 
 
+def build_update(config_data, features):
+    """
+    return False when the model can not be updated: no training summary stored, or the new batch drifted too far
+    """
+    history = read_model_history(config_data.model_prefix)
+    if history is None or "loss_quad" not in history:
+        logging.warning("No training summary for updates stored with model %s.", config_data.model_prefix)
+        return False
+    bundle = load_model_bundle(config_data.model_prefix)
+    model_regions = read_model_regions(config_data.model_prefix)
+
+    mcm_data, raw_regions = load_molcounts_data(config_data.update_count_path, features, config_data.cancer_type,
+                                                config_data.maf_key, region_subset=model_regions)
+    logging.info("Loaded %d %s/normal new batch data in %d regions.", mcm_data.shape[0], config_data.cancer_type, len(raw_regions))
+
+    reg_data = regData(config_data)
+    new_batch = get_new_batch(reg_data, mcm_data, raw_regions, config_data.iteration_start_seed)
+    trained_model, scale_model, pca_model, history, drift = update_model(
+        reg_data, bundle, history, new_batch, getattr(config_data, "drift_max_shift", 1.0))
+    logging.info("New batch drift: %.3f.", drift)
+    if trained_model is None:
+        logging.warning("New batch drifted beyond drift_max_shift.")
+        return False
+
+    write_bundle(config_data.output_prefix, trained_model, scale_model, pca_model, model_regions, history)
+    logging.info("Model updated with %d samples.", new_batch[0].shape[0] + new_batch[2].shape[0])
+    return True
+
+
+def main():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_path")
+    parser.add_argument("--update", action="store_true", help="update model_prefix with the batch at update_count_path")
+    args = parser.parse_args()
+    config_data = configData(args.config_path)
+
+    features = read_features(config_data.feature_path, config_data.bad_cohorts, config_data.bad_batches,
+                             use_cache=getattr(config_data, "feature_cache", False))
+    logging.info("Read %d samples with features.", features.shape[0])
+
+    if args.update:
+        if build_update(config_data, features):
+            return
+        logging.warning("Refitting on %s.", config_data.count_path)
+    build_full(config_data, features)
+
+
 if __name__ == "__main__":
     main()
@@ -1,12 +1,15 @@
 from math import isinf
-from mafUtility import singleRegModel, predOutcome
+from mafUtility import singleRegModel, predOutcome, get_linear_scorer
 from pandas import DataFrame
 from statistics import median, mean
-from numpy import log, log10, concatenate
-from sklearn import linear_model, preprocessing, metrics, decomposition
+from numpy import log, log10, concatenate, asarray, empty, zeros
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from sklearn import metrics, decomposition
 from scipy.special import logit, expit
 from scipy.stats import binom
-from copy import deepcopy
+from rocUtility import get_roc_confidence
+from countUtility import get_region_lengths, get_mask_counts, normalize_counts
+from estimatorFactory import get_model_specs
 
 import logging
 
@@ -26,7 +29,7 @@ class regData():
         self.min_abs_mol_count = params.min_abs_mol_count # min absolute mol count to be counted in prediction
         self.min_norm_mol_count = params.min_norm_mol_count # min normalized mol count to be counted in prediction
         self.region_filter_by_pbinom = params.region_filter_by_pbinom # min mol to be counted proportional to region length
-        self.num_cv_ = 4
+        self.num_cv_ = getattr(params, "num_cv", 4)
         self.cancer_type_str_ = params.cancer_type
         self.cancer_free_str_ = "cancer_free"
         self.label_key_ = "cancer_type"
@@ -35,6 +38,9 @@ class regData():
         self.somatic_cleanup = params.somatic_cleanup
         #self.intercept_key_ = "intercept"
         self.min_total_pos_ctrl_ = 1000
+        self.memory_budget_mb_ = getattr(params, "memory_budget_mb", None) # None: no chunking
+        self.block_bytes_ = None # transform / predict row block size left by the fits under the budget
+        self.num_workers_ = getattr(params, "num_workers", 1)
         self.follow_iter_ = 1 # number of iterations for training data points with no MAF
         self.total_explained_variance_ = 0.9 # total variance explained
         self.num_components_list = [0] * self.num_cv_ # finally how many components were used
@@ -56,32 +62,53 @@ class regData():
         self.do_transform_ = params.do_transform
         self.min_norm_count_in_max_ = 2e-06
         self.tumor_normal_ratio_min_ = params.tumor_normal_ratio_min
-        self.scaler_ = None
-        if params.scaler_str:
-            self.scaler_ = eval(params.scaler_str)
+        self.scaler_, self.regressor_ = get_model_specs(params) # estimator specs, parsed once per config string
         self.scale_model = None
         self.pca_model = None
+        self.scale_models = [] # per partition, test x stays normalized counts scored by folded models
+        self.pca_models = []
+        self.train_feature_var = None # per feature variance of scaled training data, kept for model updates
         # model
         self.is_binary_classifier_ = params.binary
-        self.regressor_ = eval(params.regressor_str)
         self.trained_model = None
+        self.model_regions = None # regions the model is trained on, after clean up
         # result
         self.pred_map = {}
+        self.sample_table = None # per test sample fold & labels, set with the CV data
         self.roc_dataframe = None
+        self.filter_stats = {"sample_ids": [], "sample_trimmed": [], "sample_omitted": [], "region_ids": [],
+                             "region_trimmed": zeros(0, dtype=int)}
         # result metrics
         self.output_metrics = {"num_components": [], "num_features_after_clean_up": None, "region_filtered(min, max, mean)": []}
+        if self.memory_budget_mb_ is not None:
+            self.output_metrics["memory_estimate_mb"] = {}
+            self.output_metrics["peak_rss_mb"] = None
+            self.output_metrics["peak_rss_children_mb"] = None
         
 
-    def _get_region_lengths(self, region_list):
-        d_thred = DataFrame(columns=["region_id", "length"])
-        for k in region_list:
-            if k == "ctrl_sum":
-                d_thred.loc[d_thred.shape[0], :] = [k, 11000]
-            else:
-                ks = k.split('_')
-                klen = int(ks[2]) - int(ks[1])
-                d_thred.loc[d_thred.shape[0], :] = [k, klen]
-        return d_thred
+    def _add_filter_stats(self, samples, regions, sample_trimmed, sample_omitted, region_trimmed):
+        # accumulate trim statistics over the groups passed to _set_split_data
+        stats = self.filter_stats
+        if stats["region_ids"] != regions:
+            stats["region_ids"] = list(regions)
+            stats["region_trimmed"] = zeros(len(regions), dtype=int)
+        stats["sample_ids"] += samples
+        stats["sample_trimmed"].append(sample_trimmed)
+        stats["sample_omitted"].append(sample_omitted)
+        stats["region_trimmed"] = stats["region_trimmed"] + region_trimmed
+
+
+    def get_filter_stats(self):
+        """
+        compact arrays of the trim / omit masks: regions trimmed & omitted per sample, trimmed sample fraction per region
+        """
+        stats = self.filter_stats
+        num_samples = len(stats["sample_ids"])
+        return {"sample_ids": asarray(stats["sample_ids"], dtype=str),
+                "sample_trimmed": concatenate(stats["sample_trimmed"]).astype("int32") if num_samples else zeros(0, dtype="int32"),
+                "sample_omitted": concatenate(stats["sample_omitted"]).astype("int32") if num_samples else zeros(0, dtype="int32"),
+                "region_ids": asarray(stats["region_ids"], dtype=str),
+                "region_trimmed_frac": (stats["region_trimmed"] / max(num_samples, 1)).astype("float32")}
 
 
     def _set_split_data(self, rawdata, regions, num_partitions, maf_exist):
@@ -91,46 +118,20 @@ class regData():
                 return
             raise Exception("Empty input data in classifier.")
 
-        trim_x = rawdata[regions + [self.ctrl_key_]].copy()
-        trim_replace_index = None
-        if not self.region_filter_by_pbinom: # use absolute cutoff for mol and norm
-            trim_replace_index = trim_x[trim_x < self.min_abs_mol_count] | trim_x[trim_x < self.min_norm_mol_count]
-            trim_x[trim_x < self.min_abs_mol_count] = 0
-            trim_x[trim_x < self.min_norm_mol_count] = 0
-        else: # use length based pbinom
-            rcounts = []
-            region_lens = self._get_region_lengths(trim_x.columns)
-            for idx, dr in trim_x.iterrows():
-                ctrl_sum = dr[self.ctrl_key_]
-                d_tmp = dr.to_frame()
-                d_tmp.columns = [idx]
-                d_tmp["region_id"] = trim_x.columns
-                d_tmp = region_lens.merge(d_tmp, how="left", on="region_id")
-                d_tmp["threshold"] = 1.5 / 100000000 * ctrl_sum * (d_tmp["length"] + 100)
-                d_tmp.loc[d_tmp[idx] < d_tmp["threshold"], idx] = -1
-                rcounts.append(d_tmp[d_tmp[idx] == -1].shape[0])
-                #d_tmp["base"] = ctrl_sum / 11000 * (d_tmp["length"].astype(float) + 100)
-                #d_tmp.loc[:, "base"] = d_tmp.loc[:, "base"].round(0)
-                #probs = []
-                #for x, v in d_tmp.iterrows():
-                #    pv = binom.cdf(k=v[idx], n=v["base"], p=5e-05)
-                #    probs.append(pv)
-                #d_tmp["prob"] = probs
-                #d_tmp.loc[d_tmp["prob"] < 0.95, idx] = -1
-                #rcounts.append(d_tmp[d_tmp["prob"] < 0.95].shape[0])
-                trim_x.loc[idx, :] = d_tmp[idx].to_list()
-            trim_replace_index = trim_x[trim_x == -1]
-            trim_x[trim_x == -1] = 0
-            self.output_metrics["region_filtered(min, max, mean)"] = [min(rcounts), max(rcounts),
-                                                                      round(sum(rcounts) / len(rcounts))]
-
-        trim_x = trim_x[regions].div(trim_x[self.ctrl_key_].values, axis=0)
-        trim_x = log10(trim_x.astype('float') + self.x_offset_)
-        if self.min_omit_coef:
-            trim_x[trim_replace_index] = 0
-
-        new_x = rawdata[regions].div(rawdata[self.ctrl_key_].values, axis=0)
-        new_x = log10(new_x.astype('float') + self.x_offset_)
+        # normalize once: train view is the full matrix, test view the trimmed copy
+        counts = rawdata[regions].to_numpy(dtype=float)
+        ctrl_sums = rawdata[self.ctrl_key_].to_numpy(dtype=float)
+        norm_x, trimmed_x, trim_mask, omit_mask = normalize_counts(counts, ctrl_sums, get_region_lengths(regions), self)
+        counts = None
+        rcounts, ocounts, sample_counts = get_mask_counts(trim_mask, omit_mask, self.num_workers_)
+        self._add_filter_stats(rawdata.index.to_list(), regions, rcounts, ocounts, sample_counts)
+        if self.region_filter_by_pbinom:
+            self.output_metrics["region_filtered(min, max, mean)"] = [int(rcounts.min()), int(rcounts.max()),
+                                                                      round(rcounts.sum() / len(rcounts))]
+        trim_mask = None
+        omit_mask = None
+        new_x = DataFrame(norm_x, index=rawdata.index, columns=regions)
+        trim_x = DataFrame(trimmed_x, index=rawdata.index, columns=regions)
 
         y_labels = rawdata[self.label_key_]
         y_labels = y_labels.replace(self.cancer_type_str_, 1)
@@ -181,37 +182,44 @@ class regData():
             pstart = pstop
 
 
-    def _transform_features(self, raw_init, raw_follow, raw_test, raw_follow_test):
+    def _fit_pca(self, d_pca):
+        """
+        PCA with the fewest components explaining total_explained_variance_
+        """
+        init_pca = decomposition.PCA()
+        init_pca.fit(d_pca)
+        total_var = 0
+        num_comp = 0
+        for v in init_pca.explained_variance_ratio_:
+            total_var += v
+            num_comp += 1
+            if total_var >= self.total_explained_variance_:
+                break
+        self.output_metrics["num_components"].append(num_comp)
+        pca_model = decomposition.PCA(n_components=num_comp)
+        pca_model.fit(d_pca)
+        return pca_model
+
+
+    def _transform_features(self, raw_init, raw_follow):
         """
         For now do PCA on normalized counts
         """
-        if not self.test_only:
-            if raw_follow is not None:
-                d_pca = concatenate((raw_init, raw_follow))
-            else:
-                d_pca = raw_init
-            init_pca = decomposition.PCA()
-            init_pca.fit(d_pca)
-            total_var = 0
-            num_comp = 0
-            for v in init_pca.explained_variance_ratio_:
-                total_var += v
-                num_comp += 1
-                if total_var >= self.total_explained_variance_:
-                    break
-            self.output_metrics["num_components"].append(num_comp)
-            self.pca_model = decomposition.PCA(n_components=num_comp)
-            self.pca_model.fit(d_pca)
-
-        t_init = self.pca_model.transform(raw_init)
-        t_test = self.pca_model.transform(raw_test)
         if raw_follow is not None:
-            t_follow = self.pca_model.transform(raw_follow)
-            t_follow_test = self.pca_model.transform(raw_follow_test)
+            d_pca = concatenate((raw_init, raw_follow))
+        else:
+            d_pca = raw_init
+        self.pca_model = self._fit_pca(d_pca)
+        if self.training_only:
+            self.train_feature_var = asarray(d_pca).var(axis=0, ddof=1)
+        d_pca = None
+
+        t_init = self._apply_by_rows(self.pca_model.transform, raw_init)
+        if raw_follow is not None:
+            t_follow = self._apply_by_rows(self.pca_model.transform, raw_follow)
         else:
             t_follow = None
-            t_follow_test = None
-        return t_init, t_follow, t_test, t_follow_test
+        return t_init, t_follow
 
 
     def _clean_input_data(self, count_data, raw_regions):
@@ -242,36 +250,152 @@ class regData():
         return new_data, new_regions
 
 
+    def _get_chunk_rows(self, num_cols):
+        """
+        rows per block so that a block of input & output float64 fits in block_bytes_
+        """
+        if self.block_bytes_ is None:
+            return None
+        return max(int(self.block_bytes_ / (2 * 8 * max(num_cols, 1))), 1)
+
+
+    def _apply_by_rows(self, func, input_x):
+        """
+        func (transform / predict) over row blocks of input_x into one preallocated output
+        """
+        num_rows = input_x.shape[0]
+        chunk_rows = self._get_chunk_rows(input_x.shape[1])
+        if chunk_rows is None or chunk_rows >= num_rows:
+            return func(input_x)
+        row_slicer = input_x.iloc if hasattr(input_x, "iloc") else input_x
+        first_block = func(row_slicer[:chunk_rows])
+        output = empty((num_rows,) + first_block.shape[1:])
+        output[:chunk_rows] = first_block
+        for rstart in range(chunk_rows, num_rows, chunk_rows):
+            output[rstart:rstart+chunk_rows] = func(row_slicer[rstart:rstart+chunk_rows])
+        return output
+
+
+    def _set_memory_estimate(self):
+        """
+        estimated peak MB of each stage from partition shapes: fits need their whole input, and what they leave of
+        the budget sets the row blocks of transforms & predictions
+        """
+        mb = 8 / 1024 / 1024
+        num_cols = self.test_x[0].shape[1]
+        max_train = 0
+        max_test = 0
+        for ii in range(self.num_cv_):
+            num_train = self.init_train_x[ii].shape[0] if ii < len(self.init_train_x) else 0
+            num_test = self.test_x[ii].shape[0]
+            if ii < len(self.follow_train_x):
+                num_train += self.follow_train_x[ii].shape[0]
+                num_test += self.follow_test_x[ii].shape[0]
+            max_train = max(max_train, num_train)
+            max_test = max(max_test, num_test)
+        data_mb = (max_train + max_test) * num_cols * mb
+        # scaler fit on concatenated train; full PCA keeps U (n x min(n, p)) & Vt (min(n, p) x p) next to its input
+        num_svd = min(max_train, num_cols)
+        fit_mb = {"normalize": data_mb + max_train * num_cols * mb,
+                  "transform": data_mb + (2 * max_train * num_cols + max_train * num_svd + num_svd * num_cols) * mb}
+        free_mb = self.memory_budget_mb_ - max(fit_mb.values())
+        if free_mb <= 0:
+            free_mb = self.memory_budget_mb_ / 16
+            logging.warning("Estimated peak %.1f MB of the fits is over the memory budget %s MB: they need their full "
+                            "input, transforms run in %.3g MB blocks.", max(fit_mb.values()), self.memory_budget_mb_, free_mb)
+        self.block_bytes_ = free_mb * 1024 * 1024
+        block_mb = 2 * min(self._get_chunk_rows(num_cols), max(max_train, max_test)) * num_cols * mb
+        estimate = self.output_metrics["memory_estimate_mb"]
+        estimate["data"] = round(data_mb, 1)
+        estimate["block"] = round(block_mb, 1)
+        for k, v in fit_mb.items():
+            estimate[k] = round(v + block_mb, 1)
+
+
+    def _set_peak_memory(self, worker_rss_kb=0):
+        # peak_rss_mb is this process only; peak_rss_children_mb is the largest worker process, from finished
+        # children (RUSAGE_CHILDREN) and worker_rss_kb reported by workers that are still running
+        if self.memory_budget_mb_ is not None:
+            self.output_metrics["peak_rss_mb"] = round(getrusage(RUSAGE_SELF).ru_maxrss / 1024, 1)
+            children_kb = max(getrusage(RUSAGE_CHILDREN).ru_maxrss, worker_rss_kb)
+            self.output_metrics["peak_rss_children_mb"] = round(children_kb / 1024, 1)
+
+
     def _normalize_input_data(self):
+        # training partitions only: test x is scored with the folded models
         for ii in range(self.num_cv_):
             if len(self.follow_train_x) > ii:
                 d_train = concatenate((self.init_train_x[ii], self.follow_train_x[ii]))
             else:
                 d_train = self.init_train_x[ii]
-            if not self.test_only:
-                self.scale_model = deepcopy(self.scaler_)
-                self.scale_model.fit(d_train)
-                self.init_train_x[ii] = self.scale_model.transform(self.init_train_x[ii])
-                if len(self.follow_train_x) > ii:
-                    self.follow_train_x[ii] = self.scale_model.transform(self.follow_train_x[ii])
-            self.test_x[ii] = self.scale_model.transform(self.test_x[ii])
+            self.scale_model = self.scaler_.build()
+            self.scale_model.fit(d_train)
+            self.scale_models.append(self.scale_model)
+            d_train = None
+            self.init_train_x[ii] = self._apply_by_rows(self.scale_model.transform, self.init_train_x[ii])
             if len(self.follow_train_x) > ii:
-                self.follow_test_x[ii] = self.scale_model.transform(self.follow_test_x[ii])
+                self.follow_train_x[ii] = self._apply_by_rows(self.scale_model.transform, self.follow_train_x[ii])
 
 
     def _transform_input_data(self):
         for ii in range(self.num_cv_):
             if ii < len(self.follow_train_x):
-                t_init_train, t_follow_train, t_init_test, t_follow_test = self._transform_features(
-                    self.init_train_x[ii], self.follow_train_x[ii], self.test_x[ii], self.follow_test_x[ii])
+                t_init_train, t_follow_train = self._transform_features(self.init_train_x[ii], self.follow_train_x[ii])
             else:
-                t_init_train, t_follow_train, t_init_test, t_follow_test = self._transform_features(
-                    self.init_train_x[ii], None, self.test_x[ii], None)
+                t_init_train, t_follow_train = self._transform_features(self.init_train_x[ii], None)
+            self.pca_models.append(self.pca_model)
             self.init_train_x[ii] = t_init_train
-            self.test_x[ii] = t_init_test
             if ii < len(self.follow_train_x):
                 self.follow_train_x[ii] = t_follow_train
-                self.follow_test_x[ii] = t_follow_test
+
+
+    def get_fold_models(self, iter_index):
+        """
+        (scale model, pca model) of a partition; the loaded models in test only mode
+        """
+        scale_model = self.scale_models[iter_index] if iter_index < len(self.scale_models) else self.scale_model
+        pca_model = self.pca_models[iter_index] if iter_index < len(self.pca_models) else self.pca_model
+        return scale_model, pca_model
+
+
+    def _score_folded(self, srm, iter_index, input_x):
+        """
+        scores of normalized count rows: scaler, PCA & linear model of the partition folded into one weight vector,
+        applied per row block without intermediate matrices; scalers that are not affine (clipping) are chained instead
+        """
+        scale_model, pca_model = self.get_fold_models(iter_index)
+        return self._apply_by_rows(get_linear_scorer(srm, scale_model, pca_model, input_x.shape[1]), input_x)
+
+
+    def _set_sample_table(self, indata):
+        """
+        one row per test sample, in partition order: fold, group (init/follow), true_y, cancer_status
+        cancer_status follows the label (1 cancer, 0 cancer free) for init and follow up samples alike
+        """
+        samples = []
+        folds = []
+        groups = []
+        true_ys = []
+        for ii in range(self.num_cv_):
+            samples += self.test_indexes[ii]
+            folds += [ii] * len(self.test_indexes[ii])
+            groups += ["init"] * len(self.test_indexes[ii])
+            true_ys += self.test_y[ii].to_list()
+            if ii < len(self.follow_test_indexes):
+                samples += self.follow_test_indexes[ii]
+                folds += [ii] * len(self.follow_test_indexes[ii])
+                groups += ["follow"] * len(self.follow_test_indexes[ii])
+                true_ys += [None] * len(self.follow_test_indexes[ii])
+        status_map = {self.cancer_type_str_: 1, self.cancer_free_str_: 0}
+        labels = indata[self.label_key_]
+        cancer_stats = labels[~labels.index.duplicated(keep="last")].map(status_map).reindex(samples)
+        self.sample_table = DataFrame(data={"fold": folds, "group": groups, "true_y": true_ys,
+                                            "cancer_status": cancer_stats.values}, index=samples)
+        # a sample id seen twice keeps one prediction, as in pred_map
+        self.sample_table = self.sample_table[~self.sample_table.index.duplicated()]
+
+        cancer_stats = [None if s != s else int(s) for s in cancer_stats.values] # NaN -> None
+        self.pred_map = {k: predOutcome(t, c) for k, t, c in zip(samples, true_ys, cancer_stats)}
 
 
     def set_cv_data(self, count_data, input_regions, shuffle_seed):
@@ -293,6 +417,7 @@ class regData():
             self.output_metrics["num_features_after_clean_up"] = len(regions)
         else:
             regions = input_regions
+        self.model_regions = regions
 
         # then set training
         if self.somatic_cleanup:
@@ -313,41 +438,18 @@ class regData():
         else:
             logging.warning("All cancer samples have MAF - this is unusual.")
 
-        if self.scaler_ is not None:
+        if self.memory_budget_mb_ is not None and len(self.test_x) > 0:
+            self._set_memory_estimate()
+        if self.scaler_ is not None and not self.test_only:
             self._normalize_input_data()
 
         # set up samples
-        for ii in range(self.num_cv_):
-            tlist = self.test_indexes[ii]
-            for j in range(len(tlist)):
-                po = predOutcome()
-                po.true_y = self.test_y[ii][j]
-                self.pred_map[tlist[j]] = po
-            if ii < len(self.follow_test_indexes):
-                tlist = self.follow_test_indexes[ii]
-                for j in range(len(tlist)):
-                    po = predOutcome()
-                    po.true_y = None
-                    self.pred_map[tlist[j]] = po
+        self._set_sample_table(indata)
 
         # transform features
-        if self.do_transform_:
+        if self.do_transform_ and not self.test_only:
             self._transform_input_data()
 
-        for s in init_cancer.index:
-            self.pred_map[s].cancer_status = 1
-        for s in init_normal.index:
-            self.pred_map[s].cancer_status = 0
-        for dname, dinfo in follows.iterrows():
-            ct = dinfo[self.label_key_]
-            if ct == self.cancer_type_str_:
-                cstatus = 1
-            elif ct == self.cancer_free_str_:
-                cstatus = 0
-            else:
-                continue
-            self.pred_map[dname].cancer_status = cstatus
-
 
     def _run_binary_training(self, srm, iter_index):
         if len(self.follow_train_x) > 0:
@@ -357,7 +459,7 @@ class regData():
             x_train = self.init_train_x[iter_index]
             y_train = self.init_train_y[iter_index]
         srm.train_binary(x_train, y_train)
-        train_y = srm.predict_prob(x_train)
+        train_y = self._apply_by_rows(srm.predict_prob, x_train)
         if len(self.follow_train_x) > 0:
             tlist = self.init_indexes[iter_index] + self.follow_train_indexes[iter_index]
         else:
@@ -369,13 +471,12 @@ class regData():
     def _run_binary_prediction(self, srm, iter_index):
         self._run_binary_training(srm, iter_index)
 
+        # score init & follow up test sets separately: no concatenated copy of test x
+        test_y = self._score_folded(srm, iter_index, self.test_x[iter_index])
+        tlist = self.test_indexes[iter_index]
         if len(self.follow_test_x) > 0:
-            x_test = concatenate((self.test_x[iter_index], self.follow_test_x[iter_index]))
-            tlist = self.test_indexes[iter_index] + self.follow_test_indexes[iter_index]
-        else:
-            x_test = self.test_x[iter_index]
-            tlist = self.test_indexes[iter_index]
-        test_y = srm.predict_prob(x_test)
+            test_y = concatenate((test_y, self._score_folded(srm, iter_index, self.follow_test_x[iter_index])))
+            tlist = tlist + self.follow_test_indexes[iter_index]
         for j in range(len(tlist)):
             self.pred_map[tlist[j]].test_y = test_y[j]
 
@@ -386,13 +487,13 @@ class regData():
         else:
             f_train = None
         srm.train_quant(self.init_train_x[iter_index], f_train, self.init_train_y[iter_index], self.follow_iter_)
-        train_y = srm.predict_quant(self.init_train_x[iter_index])
+        train_y = self._apply_by_rows(srm.predict_quant, self.init_train_x[iter_index])
         tlist = self.init_indexes[iter_index]
         for j in range(len(tlist)):
             self.pred_map[tlist[j]].train_ys.append(train_y[j])
         # follow up train
         if len(self.follow_train_x) > 0:
-            train_y = srm.predict_quant(self.follow_train_x[iter_index])
+            train_y = self._apply_by_rows(srm.predict_quant, self.follow_train_x[iter_index])
             tlist = self.follow_train_indexes[iter_index]
             for j in range(len(tlist)):
                 self.pred_map[tlist[j]].train_ys.append(train_y[j])
@@ -402,14 +503,14 @@ class regData():
         self._run_quant_training(srm, iter_index)
 
         # init test
-        test_y = srm.predict_quant(self.test_x[iter_index])
+        test_y = self._score_folded(srm, iter_index, self.test_x[iter_index])
         tlist = self.test_indexes[iter_index]
         for j in range(len(tlist)):
             self.pred_map[tlist[j]].test_y = test_y[j]
 
         # follow up test
         if len(self.follow_test_indexes) > 0:
-            test_y = srm.predict_quant(self.follow_test_x[iter_index])
+            test_y = self._score_folded(srm, iter_index, self.follow_test_x[iter_index])
             tlist = self.follow_test_indexes[iter_index]
             for j in range(len(tlist)):
                 self.pred_map[tlist[j]].test_y = test_y[j]
@@ -422,6 +523,7 @@ class regData():
                 self._run_binary_prediction(srm, ii)
             else:
                 self._run_quant_prediction(srm, ii)
+        self._set_peak_memory()
 
 
     def run_training(self):
@@ -431,66 +533,134 @@ class regData():
             self._run_binary_training(srm, 0)
         else:
             self._run_quant_training(srm, 0)
+        self._set_peak_memory()
 
 
-    def run_predict_only(self):
-        if self.follow_test_x:
-            x_test = concatenate((self.test_x[0], self.follow_test_x[0]))
-            tlist = self.test_indexes[0] + self.follow_test_indexes[0]
+    def fit_model(self, init_x, init_y, follow_x=None, follow_y=None):
+        """
+        fit scaler, PCA & regressor on given normalized training arrays, outside of the CV partitions
+        follow_y: labels for binary classifier, unused for quantitative
+        return (trained model, scale model, pca model)
+        """
+        if follow_x is not None:
+            d_train = concatenate((init_x, follow_x))
         else:
-            x_test = self.test_x[0]
-            tlist = self.test_indexes[0]
+            d_train = init_x
+        scale_model = None
+        if self.scaler_ is not None:
+            scale_model = self.scaler_.build()
+            scale_model.fit(d_train)
+            init_x = scale_model.transform(init_x)
+            if follow_x is not None:
+                follow_x = scale_model.transform(follow_x)
+        pca_model = None
+        if self.do_transform_:
+            if follow_x is not None:
+                pca_model = self._fit_pca(concatenate((init_x, follow_x)))
+            else:
+                pca_model = self._fit_pca(init_x)
+            init_x = pca_model.transform(init_x)
+            if follow_x is not None:
+                follow_x = pca_model.transform(follow_x)
+
+        srm = singleRegModel(self.regressor_)
         if self.is_binary_classifier_:
-            test_y = self.trained_model.predict_prob(x_test)
+            if follow_x is not None:
+                srm.train_binary(concatenate((init_x, follow_x)), concatenate((init_y, follow_y)))
+            else:
+                srm.train_binary(init_x, init_y)
         else:
-            test_y = self.trained_model.predict_quant(x_test)
-        for j in range(len(tlist)):
-            self.pred_map[tlist[j]].test_y = test_y[j]
+            srm.train_quant(init_x, follow_x, init_y, self.follow_iter_)
+        return srm, scale_model, pca_model
+
+
+    def get_test_matrix(self):
+        """
+        normalized (trimmed) test x of all test samples (with MAF then follow ups) in the first partition, and their names
+        """
+        if self.follow_test_x:
+            return concatenate((self.test_x[0], self.follow_test_x[0])), self.test_indexes[0] + self.follow_test_indexes[0]
+        return asarray(self.test_x[0]), self.test_indexes[0]
+
+
+    def _score_missing(self, input_x, tlist, cached_y):
+        # score only rows of input_x without a cached score; return {sample: score} of the new ones
+        new_locs = [j for j in range(len(tlist)) if tlist[j] not in cached_y]
+        if len(new_locs) == 0:
+            return {}
+        if len(new_locs) < len(tlist):
+            input_x = input_x.iloc[new_locs] if hasattr(input_x, "iloc") else input_x[new_locs]
+        test_y = self._score_folded(self.trained_model, 0, input_x)
+        return {tlist[j]: test_y[i] for i, j in enumerate(new_locs)}
+
+
+    def run_predict_only(self, cached_y=None):
+        """
+        cached_y: {sample: score} known from earlier runs, those samples are not scored again
+        return {sample: score} of the samples scored in this run
+        """
+        if cached_y is None:
+            cached_y = {}
+        new_y = self._score_missing(self.test_x[0], self.test_indexes[0], cached_y)
+        if self.follow_test_x:
+            new_y.update(self._score_missing(self.follow_test_x[0], self.follow_test_indexes[0], cached_y))
+        for k, v in list(cached_y.items()) + list(new_y.items()):
+            if k in self.pred_map:
+                self.pred_map[k].test_y = v
+        self._set_peak_memory()
+        return new_y
+
+
+    def get_score_table(self, with_train=False):
+        """
+        sample_table with the test score of this run (pred) and, with_train, the median CV training score (train)
+        """
+        score_table = self.sample_table.copy()
+        score_table["pred"] = [self.pred_map[k].test_y for k in score_table.index]
+        if with_train:
+            score_table["train"] = [median(self.pred_map[k].train_ys) for k in score_table.index]
+        return score_table
+
+
+    def _get_labeled_scores(self, rtype):
+        # (cancer status, score) of samples with a known status
+        if rtype not in ["test", "train"]:
+            raise Exception("Unable to recognize roc type: %s." % rtype)
+        score_table = self.get_score_table(with_train=(rtype == "train"))
+        score_table = score_table[score_table["cancer_status"].notna()]
+        score_col = "pred" if rtype == "test" else "train"
+        return score_table["cancer_status"].astype(int).to_list(), score_table[score_col].to_list()
 
 
     def get_roc(self, rtype="test"):
         """
         return roc curve
         """
-        test_ys = []
-        cancer_stats = []
-        for k,v in self.pred_map.items():
-            if v.cancer_status is None:
-                continue
-            if rtype == "test":
-                test_ys.append(v.test_y)
-            elif rtype == "train":
-                test_ys.append(median(v.train_ys))
-            else:
-                raise Exception("Unable to recognize roc type: %s.", rtype)
-            cancer_stats.append(v.cancer_status)
-
+        cancer_stats, test_ys = self._get_labeled_scores(rtype)
         fpr, tpr, threds = metrics.roc_curve(cancer_stats, test_ys, pos_label=1)
         self.roc_dataframe = DataFrame(data={"fpr": fpr, "tpr": tpr, "cutoff": threds})
         return self.roc_dataframe
 
 
+    def get_roc_confidence(self, spec_levels, num_bootstraps, seed):
+        """
+        bootstrap AUC & sensitivity intervals from the test predictions of this run
+        """
+        cancer_stats, test_ys = self._get_labeled_scores("test")
+        return get_roc_confidence(cancer_stats, test_ys, spec_levels, num_bootstraps, seed)
+
+
     def get_per_sample_logit_mafs(self):
         if self.roc_dataframe is None:
             raise Exception("Run get_roc first before getting per-sample logit!")
 
-        true_ys = []
-        test_ys = []
-        samples = []
-        train_ys = []
-        states = []
-        for k,v in self.pred_map.items():
-            samples.append(k)
-            true_ys.append(v.true_y)
-            test_ys.append(v.test_y)
-            if not self.test_only:
-                train_ys.append(median(v.train_ys))
-            states.append(v.cancer_status)
-        pred_dataframe = DataFrame(data={"samples": samples, "true": true_ys, "pred": test_ys, "status": states})
+        score_table = self.get_score_table(with_train=not self.test_only)
+        pred_dataframe = DataFrame(data={"samples": score_table.index.to_list(), "true": score_table["true_y"].to_list(),
+                                         "pred": score_table["pred"].to_list(), "status": score_table["cancer_status"].to_list()})
         if self.test_only:
             pred_dataframe["train"] = [0] * pred_dataframe.shape[0]
         else:
-            pred_dataframe["train"] = train_ys
+            pred_dataframe["train"] = score_table["train"].to_list()
         return pred_dataframe
 
 
@@ -511,19 +681,17 @@ class regData():
         test_ys_real = []
         true_ys_logit = []
         test_ys_logit = []
-        num_pos = 0
-        for k,v in self.pred_map.items():
-            if v.cancer_status is None:
-                continue
-            if v.test_y >= logit_cutoff:
-                num_pos += 1
-                if v.true_y is not None and not isinf(v.true_y):
-                    true_ys_logit.append(v.true_y)
-                    test_ys_logit.append(v.test_y)
-                    residuals_logit.append(v.test_y - v.true_y)
-                    true_ys_real.append(expit(v.true_y))
-                    test_ys_real.append(expit(v.test_y))
-                    residuals_real.append(expit(v.test_y) - expit(v.true_y))
+        score_table = self.get_score_table()
+        score_table = score_table[score_table["cancer_status"].notna() & (score_table["pred"] >= logit_cutoff)]
+        num_pos = score_table.shape[0]
+        for true_y, test_y in zip(score_table["true_y"], score_table["pred"]):
+            if true_y == true_y and true_y is not None and not isinf(true_y): # NaN: follow up without MAF
+                true_ys_logit.append(true_y)
+                test_ys_logit.append(test_y)
+                residuals_logit.append(test_y - true_y)
+                true_ys_real.append(expit(true_y))
+                test_ys_real.append(expit(test_y))
+                residuals_real.append(expit(test_y) - expit(true_y))
 
         r2_result = DataFrame(data={"r2": [], "mean_residual": [], "median_residual": [], "num_positive": [], "cutoff": []})
         r2_val = metrics.r2_score(true_ys_logit, test_ys_logit)
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 
 import logging
-import json
 from sys import argv
-from scipy.sparse.construct import rand
 from configData import configData
 from Classifier import regData
-from dataInterface import read_features, load_molcounts_data, set_roc, convert_roc_map_to_dataframe
+from mafUtility import fold_linear_model, get_linear_scorer, is_foldable
+from numpy import array, matmul
+from concurrent.futures import ProcessPoolExecutor
+from dataInterface import read_features, load_molcounts_data, set_roc, convert_roc_map_to_dataframe, resultWriter
 
 """
 Test two datasets: late-stage only model & late+early, with fixed size
+Test samples are normalized once and scored by every trained model together
 """
 
 def main():
@@ -21,9 +23,11 @@ def main():
     cancer_type = "crc"
     num_digits = 4
 
-    features = read_features(config_data.feature_path)
+    features = read_features(config_data.feature_path, getattr(config_data, "bad_cohorts", []),
+                             getattr(config_data, "bad_batches", []), use_cache=getattr(config_data, "feature_cache", False))
     logging.info("Read %d samples with features.", features.shape[0])
-    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, cancer_type)
+    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, cancer_type, config_data.maf_key,
+                                                use_cache=getattr(config_data, "count_cache", False))
     logging.info("Loaded %d %s/normal data in %d regions.", mcm_data.shape[0], cancer_type, len(raw_regions))
 
     # generate late-stage only training set
@@ -47,22 +51,95 @@ def main():
     dt_train_mix = train_late.append(train_early).append(train_normal)
     dt_test = test_early.append(test_normal)
 
+    arm_trains = {"late": dt_train_late, "mix": dt_train_mix}
+    run_batched_testing(config_data, num_digits, arm_trains, dt_test, raw_regions)
+
+
+# training sets shared with worker processes, set once per worker
+_arm_trains = None
+
+
+def _init_worker(arm_trains):
+    global _arm_trains
+    _arm_trains = arm_trains
+
+
+def fit_training_model(arm, input_regions, config_data, shuffle_seed):
+    train_reg = regData(config_data)
+    train_reg.training_only = True
+    train_reg.set_cv_data(_arm_trains[arm], input_regions, shuffle_seed)
+    train_reg.run_training()
+    return train_reg.trained_model, train_reg.scale_model, train_reg.pca_model
+
+
+def get_test_matrix(config_data, dt_test, input_regions, shuffle_seed):
+    """
+    normalize test samples once: no scaler & PCA here, they are folded into each model's weights
+    """
+    test_reg = regData(config_data)
+    test_reg.test_only = True
+    test_reg.scaler_ = None
+    test_reg.do_transform_ = False
+    test_reg.set_cv_data(dt_test, input_regions, shuffle_seed)
+    x_test, tlist = test_reg.get_test_matrix()
+    return test_reg, x_test, tlist
+
+
+def run_batched_testing(config_data, num_digits, arm_trains, dt_test, raw_regions):
+    """
+    fit every (arm, seed) model in parallel, then score all of them on the shared test matrix in one product
+    """
+    seeds = [config_data.iteration_start_seed + i for i in range(config_data.total_iterations)]
+    test_reg, x_test, tlist = get_test_matrix(config_data, dt_test, raw_regions, seeds[0])
+    logging.info("Normalized %d test samples.", len(tlist))
+
+    tasks = [(arm, seed) for arm in arm_trains for seed in seeds]
+    num_workers = getattr(config_data, "num_workers", 1)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(arm_trains,)) as pool:
+        jobs = [pool.submit(fit_training_model, arm, raw_regions, config_data, seed) for (arm, seed) in tasks]
+        trained = [job.result() for job in jobs]
+    logging.info("Trained %d models.", len(trained))
+
+    if all(is_foldable(sm) for (tm, sm, pm) in trained):
+        folded = [fold_linear_model(tm, sm, pm, x_test.shape[1]) for (tm, sm, pm) in trained]
+        weights = array([w for (w, b) in folded])
+        biases = array([b for (w, b) in folded])
+        all_scores = matmul(x_test, weights.T) + biases
+    else: # scaler with clipping: one chained transform per model
+        all_scores = array([get_linear_scorer(tm, sm, pm, x_test.shape[1])(x_test) for (tm, sm, pm) in trained]).T
+
     raw_prefix = config_data.output_prefix
-    config_data.output_prefix = raw_prefix + ".late"
-    run_iterated_testing(config_data, num_digits, dt_train_late, dt_test, raw_regions)
-    config_data.output_prefix = raw_prefix + ".mix"
-    run_iterated_testing(config_data, num_digits, dt_train_mix, dt_test, raw_regions)
+    for arm in arm_trains:
+        config_data.output_prefix = raw_prefix + "." + arm
+        iter_results = []
+        for cv_idx in range(len(seeds)):
+            scores = all_scores[:, tasks.index((arm, seeds[cv_idx]))]
+            iter_results.append(get_iteration_result(test_reg, tlist, scores, config_data))
+        write_iterated_results(config_data, num_digits, iter_results)
+    config_data.output_prefix = raw_prefix
+
+
+def get_iteration_result(test_reg, tlist, scores, config_data):
+    for j in range(len(tlist)):
+        test_reg.pred_map[tlist[j]].test_y = scores[j]
+    roc_result = test_reg.get_roc()
+    if config_data.binary:
+        r2_result = None
+    else:
+        r2_result = test_reg.get_r2_stats_dataframe(0.95)
+    pred_dataframe = test_reg.get_per_sample_logit_mafs()
+    return r2_result, roc_result, pred_dataframe, dict(test_reg.output_metrics)
 
 
-def run_iterated_testing(config_data, num_digits, dt_train, dt_test, raw_regions):
-    logging.info("Start CV.")
+def write_iterated_results(config_data, num_digits, iter_results):
+    writer = resultWriter(config_data.output_prefix, getattr(config_data, "partial_output_format", None),
+                          getattr(config_data, "pred_format", "tsv"))
     roc_map = {}
     final_r2 = None
     final_pred = None
     final_metrics = []
-    for cv_idx in range(config_data.total_iterations):
-        shuffle_seed = config_data.iteration_start_seed + cv_idx
-        r2_result, roc_result, pred_dataframe, out_metrics = run_single_iteration(dt_train, dt_test, raw_regions, config_data, shuffle_seed)
+    for cv_idx, (r2_result, roc_result, pred_dataframe, out_metrics) in enumerate(iter_results):
+        writer.write_iteration(cv_idx, roc_result, r2_result, pred_dataframe)
         set_roc(roc_map, roc_result, num_digits=3)
         if cv_idx == 0:
             final_r2 = r2_result
@@ -81,37 +158,11 @@ def run_iterated_testing(config_data, num_digits, dt_train, dt_test, raw_regions
         final_metrics.append(out_metrics)
 
     final_roc = convert_roc_map_to_dataframe(roc_map, num_digits)
-    final_roc.to_csv(config_data.output_prefix + ".roc.tsv", sep='\t', index=False)
-    if not config_data.binary:
-        final_r2.to_csv(config_data.output_prefix + ".r2.tsv", sep='\t', index=True)
-    final_pred = final_pred.round(num_digits)
-    final_pred.to_csv(config_data.output_prefix + ".pred.tsv", sep='\t', index=True)
-    outfile = open(config_data.output_prefix + ".metrics.json", 'w')
-    json.dump(final_metrics, outfile)
-    outfile.close()
-
-
-def run_single_iteration(dt_train, dt_test, input_regions, config_data, shuffle_seed):
-    train_reg = regData(config_data)
-    train_reg.training_only = True
-    train_reg.set_cv_data(dt_train, input_regions, shuffle_seed)
-    train_reg.run_training()
-
-    test_reg = regData(config_data)
-    test_reg.test_only = True
-    test_reg.trained_model = train_reg.trained_model
-    test_reg.scale_model = train_reg.scale_model
-    test_reg.pca_model = train_reg.pca_model
-    test_reg.set_cv_data(dt_test, input_regions, shuffle_seed)
-    test_reg.run_predict_only()
-    
-    roc_result = test_reg.get_roc()
     if config_data.binary:
-        r2_result = None
-    else:
-        r2_result = test_reg.get_r2_stats_dataframe(0.95)
-    pred_dataframe = test_reg.get_per_sample_logit_mafs()
-    return r2_result, roc_result, pred_dataframe, test_reg.output_metrics
+        final_r2 = None
+    final_pred = final_pred.round(num_digits)
+    writer.dump_prediction_result(final_roc, final_r2, final_pred, final_metrics)
+    writer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import logging
+from sys import argv
+from configData import configData
+from Run_mcm_models import get_checkpoint_dir, merge_iteration_results
+
+from dataInterface import load_iteration_checkpoint, dump_prediction_result, print_result_summary
+
+"""
+Merge seed checkpoints written by sharded Run_mcm_models.py runs into the usual outputs
+"""
+
+def main():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    for config_path in argv[1:]:
+        merge_config_shards(configData(config_path))
+
+
+def merge_config_shards(config_data):
+    checkpoint_dir = get_checkpoint_dir(config_data)
+    iter_results = []
+    missing_seeds = []
+    for cv_idx in range(config_data.total_iterations):
+        shuffle_seed = config_data.iteration_start_seed + cv_idx
+        iter_result = load_iteration_checkpoint(checkpoint_dir, config_data, shuffle_seed)
+        if iter_result is None:
+            missing_seeds.append(shuffle_seed)
+        iter_results.append(iter_result)
+    if missing_seeds:
+        raise Exception("Missing %d seeds in %s: %s" % (len(missing_seeds), checkpoint_dir, missing_seeds))
+
+    final_roc, final_r2, final_pred, final_metrics = merge_iteration_results(iter_results, config_data)
+    dump_prediction_result(config_data.output_prefix, final_roc, final_r2, final_pred, final_metrics,
+                           getattr(config_data, "pred_format", "tsv"))
+    print_result_summary(final_roc, final_r2)
+    logging.info("Merged %d seeds into %s", len(iter_results), config_data.output_prefix)
+
+
+if __name__ == "__main__":
+    main()
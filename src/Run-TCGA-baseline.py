@@ -1,81 +1,97 @@
 #/usr/bin/env python3
 
 """
-TCGA baseline model for given cancer type
+TCGA baseline model for given cancer types (or "all"), scored together from one load of the shared data
 """
 
-from pandas import read_csv, merge, DataFrame
+from pandas import read_csv, DataFrame
 from feather import read_dataframe
 from sklearn import metrics, linear_model
-from numpy import log, exp
+from numpy import log
+from scipy.sparse import vstack
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+from tcgaUtility import load_probe_counts, tcgaStore
 import sys
 
 
 def main():
     #logging.basicConfig()
     #logging.getLogger().setLevel(logging.INFO)
-    test_type = sys.argv[1]
-    if test_type == "crc":
-        maf_key_ = "max_maf_pct"
-    else:
-        maf_key_ = "G360_max_maf_pct"
-
     tcga_map = {"lung": ["LUAD", "LUSC"], "breast": ["BRCA"], "bladder": ["BLCA"], "prostate": ["PRAD"], 
             "ovarian": ["OV"], "pancreatic": ["PAAD"], "gastric": ["STAD"], }
 
+    test_types = sys.argv[1:] # one or more cancer types, or "all"
+    if test_types == ["all"]:
+        test_types = list(tcga_map.keys())
+
     head_path = "/ghdevhome/home/schen/epigen/ccbi-308/mcm_probe.head2.tsv"
     data_path = "/ghdevhome/home/schen/epigen/ccbi-308/mcm_probe.full_tcga.dedup.tsv"
 
     print("loading tcga data...")
-    d_head = read_csv(head_path, sep='\t', header=0)
-    colnames = d_head.columns.to_list()
-    samples = colnames[1:]
-    colnames.append("probe_450k")
-    d_head.index = d_head["region_id"]
-    d_head.pop("region_id")
-
-    dt_msre = read_csv(data_path, sep='\t', header=None)
-    dt_msre.columns = colnames
-    dt_msre.index = dt_msre["region_id"].to_list()
-    dt_msre.pop("region_id")
+    probe_counts = load_probe_counts(head_path, data_path)
 
     outdir = "tcga_result/"
-    roc_path = outdir + test_type + ".roc.tsv"
-    pred_path = outdir + test_type + ".pred.tsv"
 
     print("loading TCGA...")
-    meta_tumor, meta_normal = load_tcga_data(tcga_map[test_type])
+    store_dir = "tcga_store/"
+    all_projects = sorted(set(p for t in test_types for p in tcga_map[t]))
+    tcga_store = load_tcga_data(all_projects, store_dir)
 
     print("start modeling...")
     feature_path = "/ghdevhome/home/schen/epigen/ccbi-327/data/methylome_V2_samples.090921.tsv"
     features = read_csv(feature_path, sep='\t', header=0)
     features.loc[features.cohort=="G360_CRC", "stage_info"] = "stage_iv"
 
-    prv_preds = get_tcga_predictions(test_type, meta_tumor, dt_msre, features, prev_as_weight, maf_key_)
+    # all cancer types scored by one product of the stacked weights with the counts
+    prv_weights = [tcga_store.get_prevalence(tcga_map[t], 0.5) for t in test_types]
+    all_sums = get_weighted_sums(prv_weights, probe_counts)
+
+    with ProcessPoolExecutor(max_workers=min(len(test_types), cpu_count())) as pool:
+        jobs = []
+        for i, test_type in enumerate(test_types):
+            jobs.append(pool.submit(run_cancer_baseline, test_type, all_sums[i], probe_counts.samples, features,
+                                    get_maf_key(test_type), outdir))
+        for job in jobs:
+            job.result()
+
+
+def get_maf_key(test_type):
+    if test_type == "crc":
+        return "max_maf_pct"
+    return "G360_max_maf_pct"
+
+
+def get_weighted_sums(weight_list, probe_counts):
+    """
+    weight_list: per-probe weight Series; return len(weight_list) x sample matrix of weighted count sums
+    """
+    weight_rows = []
+    for probe_weights in weight_list:
+        print("Total sites = %d, >=0.5 weight = %d." % (len(probe_weights), (probe_weights >= 0.5).sum()))
+        weight_row = probe_counts.get_weight_vector(probe_weights)
+        print("Merged probes = %d, >=0.5 probes = %d." % (weight_row.nnz, (weight_row.data >= 0.5).sum()))
+        weight_rows.append(weight_row)
+    return probe_counts.get_weighted_sums(vstack(weight_rows, format="csr"))
+
+
+def run_cancer_baseline(test_type, sample_sums, samples, features, maf_key_, outdir):
+    roc_path = outdir + test_type + ".roc.tsv"
+    pred_path = outdir + test_type + ".pred.tsv"
+
+    prv_preds = set_tcga_predictions(test_type, sample_sums, samples, features, maf_key_)
     prv_fpr, prv_tpr, prv_threds = get_roc_data(prv_preds, test_type)
     prv_preds, prv_true, prv_r2 = get_maf_result(prv_preds, prv_fpr, prv_threds, test_type, prv_tpr, maf_key_)
 
     roc_df = DataFrame(data={"fpr": prv_fpr, "tpr": prv_tpr, "thresholds": prv_threds})
     roc_df.to_csv(roc_path, sep='\t', index=False)
-    pred_df = DataFrame(data={"samples": samples, "pred": prv_preds, "true": prv_true})
+    pred_samples = prv_true.index.to_list() if prv_true is not None else []
+    pred_df = DataFrame(data={"samples": pred_samples, "pred": prv_preds, "true": prv_true})
     pred_df.to_csv(pred_path, sep='\t', index=False)
 
 
-def get_tcga_predictions(test_type, d_meta, dt_msre, features, weight_function, maf_key_):
-    df_weight = weight_function(d_meta)
-    first_col_nm = df_weight.columns[0]
-    dl = df_weight[first_col_nm].to_list()
-    print("Total sites = %d, >=0.5 weight = %d." % (len(dl), len([x for x in dl if x >= 0.5])))
-    df_weight.columns = ["weight"]
-    dt_mols = dt_msre.merge(df_weight, left_on="probe_450k", right_index=True)
-    print("Merged probes = %d, >=0.5 probes = %d." % (dt_mols.shape[0], dt_mols[dt_mols["weight"]>=0.5].shape[0]))
-
-    sample_cols = dt_mols.columns.to_list()
-    sample_cols.remove("weight")
-    sample_cols.remove("probe_450k")
-    wt_m = dt_mols[sample_cols].multiply(dt_mols["weight"], axis="index")
-
-    tcga_preds = wt_m.sum(axis=0).to_frame()
+def set_tcga_predictions(test_type, sample_sums, samples, features, maf_key_):
+    tcga_preds = DataFrame(data={"pred": sample_sums}, index=samples)
     fcols = ["sample_id", maf_key_, "cancer_type", "somatic_call"]
     tcga_preds = tcga_preds.merge(features[fcols], left_index=True, right_on="sample_id")
     #print(tcga_preds[maf_key_])
@@ -117,38 +133,19 @@ def get_maf_result(tcga_preds, fpr, thresholds, test_type, tpr, maf_key_):
     return m_pred, m_true, pred_r2
 
 
-def prev_as_weight(d_meta):
-    tcga_cutoff = 0.5
-    cols = d_meta.columns.to_list()
-    for k in ["sample_id", "sample_type", "percent_tumor_nuclei"]:
-        cols.remove(k)
-    dw = d_meta[cols].gt(tcga_cutoff).sum(axis=0).div(d_meta[cols].shape[0]).to_frame()
-    return dw
-
-
-def plain_weight(d_meta):
-    cols = d_meta.columns.to_list()
-    for k in ["sample_id", "sample_type", "percent_tumor_nuclei"]:
-        cols.remove(k)
-    dw = DataFrame(data={"X0": [1] * len(cols)}, index=cols)
-    return dw
-
-
-def load_tcga_data(project_names):
-    meta_data = None
+def load_tcga_data(project_names, store_dir):
+    """
+    return the TCGA store holding the projects; projects not in the store yet are read from feather once
+    use tcga_store.get_prevalence(project_names) for the per-probe weights (fraction of tumors with beta > 0.5)
+    """
+    tcga_store = tcgaStore(store_dir)
     for pname in project_names:
+        if pname.upper() in tcga_store.projects:
+            continue
         meta_path = "/ghds/groups/lunar/data/TCGA/update/" + pname.upper()
         meta_path += "/" + pname.lower() + "_450k_meth_beta_metadata.feather"
-        if meta_data is None:
-            meta_data = read_dataframe(meta_path)
-        else:
-            d_tmp = read_dataframe(meta_path)
-            meta_data = meta_data.append(d_tmp)
-            
-    meta_tumor = meta_data[(meta_data["sample_type"]=="Primary Tumor") & (meta_data["percent_tumor_nuclei"]>=0.5)]
-    meta_normal = meta_data[meta_data["sample_type"]=="Solid Tissue Normal"]
-        
-    return meta_tumor, meta_normal
+        tcga_store.add_project(pname, read_dataframe(meta_path))
+    return tcga_store
 
 
 if __name__ == "__main__":
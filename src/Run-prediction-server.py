@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import argparse
+from configData import configData
+from numpy import matmul
+from mafUtility import get_linear_scorer
+from predictionServer import predictionServer
+from streamPredictor import streamPredictor
+
+from dataInterface import load_model_bundle, read_model_regions, load_npz_model
+
+"""
+Long-lived local scoring service: .pickle models from Build-models.py (model_prefix) or an npz bundle
+from Model-pickle-to-npz.py; concurrent requests are scored in micro-batches
+"""
+
+def main():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_path")
+    parser.add_argument("--npz", default=None, help="npz bundle to serve instead of the pickled model_prefix")
+    parser.add_argument("--npz-model", default=None, help="model name in the npz bundle (default: first)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+    config_data = configData(args.config_path)
+
+    if args.npz is not None:
+        model_regions, weight, bias = load_npz_model(args.npz, args.npz_model)
+        scorer = lambda x: matmul(x, weight) + bias
+        logging.info("Loaded npz model from %s with %d regions.", args.npz, len(model_regions))
+    else:
+        trained_model, scale_model, pca_model = load_model_bundle(config_data.model_prefix)
+        model_regions = read_model_regions(config_data.model_prefix)
+        if model_regions is None:
+            raise Exception("Prediction server needs the region list of model %s." % config_data.model_prefix)
+        scorer = get_linear_scorer(trained_model, scale_model, pca_model, len(model_regions))
+        logging.info("Loaded model %s with %d regions.", config_data.model_prefix, len(model_regions))
+
+    predictor = streamPredictor(config_data, model_regions, scorer)
+    server = predictionServer(predictor, args.max_batch_size, args.max_wait_ms)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
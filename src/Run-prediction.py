@@ -2,14 +2,32 @@ import logging
 from sys import argv
 from Classifier import regData
 from configData import configData
-import pickle
+from predictionCache import predictionCache, get_bundle_hash, get_sample_keys
 
-from dataInterface import read_features, load_molcounts_data, set_roc, convert_roc_map_to_dataframe, dump_prediction_result
+from dataInterface import read_features, load_molcounts_data, set_roc, convert_roc_map_to_dataframe, dump_prediction_result, \
+    read_model_regions, load_model_bundle, write_filter_stats
 
 """
 Only build model with the input full data and dump with pickle
 """
 
+def run_cached_prediction(reg_data, sample_counts, cache_path, config_data):
+    """
+    score only samples whose (count vector, model) are not in the prediction cache
+    """
+    cache = predictionCache(cache_path, getattr(config_data, "prediction_cache_max_entries", 1000000))
+    sample_keys = dict(zip(sample_counts.index, get_sample_keys(get_bundle_hash(config_data.model_prefix, config_data),
+                                                                sample_counts.to_numpy())))
+    scored = [k for k in reg_data.pred_map if k in sample_keys]
+    found = cache.get_many([sample_keys[k] for k in scored])
+    cached_y = {k: found[sample_keys[k]] for k in scored if sample_keys[k] in found}
+    new_y = reg_data.run_predict_only(cached_y)
+    cache.put_many({sample_keys[k]: v for k, v in new_y.items()})
+    reg_data.output_metrics["prediction_cache"] = cache.get_stats()
+    logging.info("Prediction cache: %d hits, %d misses.", cache.num_hits, cache.num_misses)
+    cache.close()
+
+
 def main():
     logging.basicConfig()
     logging.getLogger().setLevel(logging.INFO)
@@ -17,16 +35,16 @@ def main():
     config_path = argv[1]
     config_data = configData(config_path)
 
-    pickle_items = []
-    for suffix in ["predictor", "scaler", "transformer"]:
-        infile = open(config_data.model_prefix + "." + suffix + ".pkl", 'rb')
-        pcontent = pickle.load(infile)
-        pickle_items.append(pcontent)
-        infile.close()
-    
-    features = read_features(config_data.feature_path, config_data.bad_cohorts, config_data.bad_batches)
+    pickle_items = load_model_bundle(config_data.model_prefix)
+    model_regions = read_model_regions(config_data.model_prefix)
+    if model_regions is None:
+        logging.warning("No region list stored with model %s - loading all regions.", config_data.model_prefix)
+
+    features = read_features(config_data.feature_path, config_data.bad_cohorts, config_data.bad_batches,
+                             use_cache=getattr(config_data, "feature_cache", False))
     logging.info("Read %d samples with features.", features.shape[0])
-    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, config_data.cancer_type, config_data.maf_key)
+    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, config_data.cancer_type, config_data.maf_key,
+                                                region_subset=model_regions, use_cache=getattr(config_data, "count_cache", False))
     logging.info("Loaded %d %s/normal data in %d regions.", mcm_data.shape[0], config_data.cancer_type, len(raw_regions))
 
     # manually change some reg_data params, as in building models
@@ -37,7 +55,12 @@ def main():
     reg_data.scale_model = pickle_items[1]
     reg_data.pca_model = pickle_items[2]
     reg_data.set_cv_data(mcm_data, raw_regions, config_data.iteration_start_seed)
-    reg_data.run_predict_only()
+    write_filter_stats(config_data.output_prefix, reg_data.get_filter_stats())
+    cache_path = getattr(config_data, "prediction_cache", None)
+    if cache_path is None:
+        reg_data.run_predict_only()
+    else:
+        run_cached_prediction(reg_data, mcm_data[raw_regions + [reg_data.ctrl_key_]], cache_path, config_data)
     
     roc_result = reg_data.get_roc()
     if config_data.binary:
@@ -45,6 +68,10 @@ def main():
     else:
         r2_result = reg_data.get_r2_stats_dataframe(0.95) 
     pred_dataframe = reg_data.get_per_sample_logit_mafs()
+    num_bootstraps = getattr(config_data, "num_bootstraps", 0)
+    if num_bootstraps > 0:
+        roc_ci = reg_data.get_roc_confidence([0.95, 0.98], num_bootstraps, config_data.iteration_start_seed)
+        reg_data.output_metrics["roc_ci"] = roc_ci.to_dict(orient="records")
 
     roc_map = {}
     set_roc(roc_map, roc_result, config_data.num_digits - 1)
@@ -53,7 +80,8 @@ def main():
     pred_dataframe.index = pred_dataframe["samples"]
     pred_dataframe.pop("samples")
 
-    dump_prediction_result(config_data.output_prefix, final_roc, r2_result, pred_dataframe, reg_data.output_metrics)
+    dump_prediction_result(config_data.output_prefix, final_roc, r2_result, pred_dataframe, reg_data.output_metrics,
+                           getattr(config_data, "pred_format", "tsv"))
     logging.info("Finished prediction at %s", config_data.output_prefix)
 
 
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import argparse
+import os
+import shutil
+import time
+from sys import exit
+from numpy import abs as np_abs
+from pandas import read_csv
+from configData import configData
+import Run_mcm_models
+
+"""
+Golden-output check of the CV pipeline: run configs end to end through Run_mcm_models.run_config, compare
+.roc/.pred/.r2 to stored references within a tolerance and per-stage timings to the reference timings;
+exit 1 on numeric drift or slowdown
+--update-reference stores the current outputs & timings as the new references
+"""
+
+result_suffixes = [".roc.tsv", ".pred.tsv", ".r2.tsv"]
+# functions of Run_mcm_models timed as stages of run_config
+timed_stages = ["read_features", "load_molcounts_data", "run_scheduled_iterations", "run_single_iteration",
+                "merge_iteration_results"]
+
+
+def main():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_paths", nargs='+')
+    parser.add_argument("--reference-dir", default="fixtures/reference", help="reference outputs & timings, one set per config name")
+    parser.add_argument("--work-dir", default="regression_output", help="where outputs of this run are written")
+    parser.add_argument("--update-reference", action="store_true")
+    parser.add_argument("--atol", type=float, default=1e-6)
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--max-slowdown", type=float, default=1.25, help="largest allowed stage time / reference time")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per config; each stage keeps its fastest time")
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="stages faster than this in the reference are not timed (the total always is)")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    report = {}
+    for config_path in args.config_paths:
+        name = os.path.splitext(os.path.basename(config_path))[0]
+        try:
+            timings = get_best_timings([run_config(config_path, os.path.join(args.work_dir, name))
+                                        for i in range(max(args.repeats, 1))])
+        except Exception as e:
+            logging.error("Config %s failed: %s", name, e)
+            report[name] = {"error": str(e), "failures": ["run failed"]}
+            continue
+        out_prefix = os.path.join(args.work_dir, name)
+        ref_prefix = os.path.join(args.reference_dir, name)
+        if args.update_reference:
+            update_reference(out_prefix, ref_prefix, timings)
+            report[name] = {"timings": timings, "failures": []}
+            logging.info("Reference of %s updated.", name)
+            continue
+        failures = compare_outputs(out_prefix, ref_prefix, args.atol, args.rtol)
+        failures += compare_timings(timings, ref_prefix, args.max_slowdown, args.min_seconds)
+        report[name] = {"timings": timings, "failures": failures}
+
+    outfile = open(os.path.join(args.work_dir, "regression_report.json"), 'w')
+    json.dump(report, outfile, indent=1)
+    outfile.close()
+    print_report(report)
+    if any(len(r["failures"]) > 0 for r in report.values()):
+        exit(1)
+
+
+def run_config(config_path, out_prefix):
+    """
+    Run_mcm_models.run_config on all iterations, with a timer per stage; return {stage: seconds}
+    """
+    config_data = configData(config_path)
+    config_data.output_prefix = out_prefix
+    timings = {}
+
+    def get_timed(stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+            return result
+        return timed
+
+    stage_funcs = {stage: getattr(Run_mcm_models, stage) for stage in timed_stages}
+    for stage, func in stage_funcs.items():
+        setattr(Run_mcm_models, stage, get_timed(stage, func))
+    start = time.perf_counter()
+    try:
+        Run_mcm_models.run_config(config_data, list(range(config_data.total_iterations)), False, True)
+    finally:
+        for stage, func in stage_funcs.items():
+            setattr(Run_mcm_models, stage, func)
+    timings["total"] = time.perf_counter() - start
+    return {k: round(v, 4) for k, v in timings.items()}
+
+
+def get_best_timings(run_timings):
+    # fastest time of each stage over repeated runs, less sensitive to machine load than a single run
+    return {stage: min(t[stage] for t in run_timings) for stage in run_timings[0]}
+
+
+def update_reference(out_prefix, ref_prefix, timings):
+    os.makedirs(os.path.dirname(ref_prefix) or ".", exist_ok=True)
+    for suffix in result_suffixes:
+        if os.path.exists(ref_prefix + suffix):
+            os.remove(ref_prefix + suffix)
+        if os.path.exists(out_prefix + suffix):
+            shutil.copyfile(out_prefix + suffix, ref_prefix + suffix)
+    outfile = open(ref_prefix + ".timings.json", 'w')
+    json.dump(timings, outfile, indent=1)
+    outfile.close()
+
+
+def compare_table(out_path, ref_path, atol, rtol):
+    """
+    return a failure message, or None when both tables match within tolerance
+    """
+    out_table = read_csv(out_path, sep='\t', header=0)
+    ref_table = read_csv(ref_path, sep='\t', header=0)
+    if list(out_table.columns) != list(ref_table.columns) or out_table.shape != ref_table.shape:
+        return "shape/columns differ: %s vs reference %s" % (out_table.shape, ref_table.shape)
+    num_cols = ref_table.select_dtypes("number").columns
+    for c in ref_table.columns:
+        if c not in num_cols:
+            if not (out_table[c].astype(str) == ref_table[c].astype(str)).all():
+                return "values of %s differ" % c
+            continue
+        out_vals = out_table[c].astype(float).values
+        ref_vals = ref_table[c].astype(float).values
+        if ((out_vals != out_vals) != (ref_vals != ref_vals)).any():
+            return "missing values of %s differ" % c
+        diff = np_abs(out_vals - ref_vals)
+        over = (diff > atol + rtol * np_abs(ref_vals)) & (ref_vals == ref_vals)
+        if over.any():
+            return "%s drifts by up to %g" % (c, diff[over].max())
+    return None
+
+
+def compare_outputs(out_prefix, ref_prefix, atol, rtol):
+    failures = []
+    for suffix in result_suffixes:
+        out_exists = os.path.exists(out_prefix + suffix)
+        if not os.path.exists(ref_prefix + suffix):
+            if out_exists:
+                failures.append("%s: no reference" % suffix)
+            continue
+        if not out_exists:
+            failures.append("%s: not written" % suffix)
+            continue
+        message = compare_table(out_prefix + suffix, ref_prefix + suffix, atol, rtol)
+        if message is not None:
+            failures.append("%s: %s" % (suffix, message))
+    return failures
+
+
+def compare_timings(timings, ref_prefix, max_slowdown, min_seconds):
+    """
+    the total and stages of at least min_seconds in the reference may be at most max_slowdown times slower
+    fail when nothing could be timed, warn when only the total is
+    """
+    if not os.path.exists(ref_prefix + ".timings.json"):
+        return ["no reference timings"]
+    infile = open(ref_prefix + ".timings.json", 'r')
+    ref_timings = json.load(infile)
+    infile.close()
+    failures = []
+    timed = []
+    for stage, ref_seconds in ref_timings.items():
+        if stage not in timings or (ref_seconds < min_seconds and stage != "total"):
+            continue
+        timed.append(stage)
+        if timings[stage] > ref_seconds * max_slowdown:
+            failures.append("%s: %.2fs vs reference %.2fs" % (stage, timings[stage], ref_seconds))
+    if len(timed) == 0:
+        failures.append("no stage timed: the reference has no total and no stage of at least %.2fs" % min_seconds)
+    elif timed == ["total"]:
+        logging.warning("Only the total of %s is timed: no stage reaches %.2fs in the reference.", ref_prefix, min_seconds)
+    return failures
+
+
+def print_report(report):
+    for name, result in report.items():
+        status = "FAIL" if result["failures"] else "OK"
+        print("%s\t%s" % (name, status))
+        for stage, seconds in result.get("timings", {}).items():
+            print("\t%s\t%.3fs" % (stage, seconds))
+        for failure in result["failures"]:
+            print("\t! %s" % failure)
+
+
+if __name__ == "__main__":
+    main()
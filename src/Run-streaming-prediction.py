@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import logging
+import argparse
+from sys import stdin, stdout
+from configData import configData
+from mafUtility import get_linear_scorer
+from predictionCache import predictionCache, get_bundle_hash
+from streamPredictor import streamPredictor, read_json_records, watch_directory
+
+from dataInterface import load_model_bundle, read_model_regions
+
+"""
+Score samples as they arrive, with .pickle models from Build-models.py
+Input is either json lines on stdin or per-sample count files dropped into a directory
+"""
+
+def main():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_path")
+    parser.add_argument("--watch", default=None, help="directory to watch for per-sample count files")
+    parser.add_argument("--suffix", default=".tsv", help="suffix of per-sample count files")
+    parser.add_argument("--poll-seconds", type=float, default=5.0)
+    args = parser.parse_args()
+    config_data = configData(args.config_path)
+
+    trained_model, scale_model, pca_model = load_model_bundle(config_data.model_prefix)
+    model_regions = read_model_regions(config_data.model_prefix)
+    if model_regions is None:
+        raise Exception("Streaming prediction needs the region list of model %s." % config_data.model_prefix)
+
+    predictor = streamPredictor(config_data, model_regions,
+                                get_linear_scorer(trained_model, scale_model, pca_model, len(model_regions)))
+    logging.info("Loaded model %s with %d regions.", config_data.model_prefix, len(model_regions))
+    cache_path = getattr(config_data, "prediction_cache", None)
+    if cache_path is not None:
+        predictor.set_cache(predictionCache(cache_path, getattr(config_data, "prediction_cache_max_entries", 1000000)),
+                            get_bundle_hash(config_data.model_prefix, config_data))
+
+    if args.watch is not None:
+        records = watch_directory(args.watch, args.suffix, args.poll_seconds)
+    else:
+        records = read_json_records(stdin)
+    predictor.run(records, stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import logging
+from sys import argv
+from configData import configData
+from subsampleEngine import subsampleEngine
+
+from dataInterface import read_features, load_molcounts_data
+
+"""
+Learning curves: sensitivity at fixed specificity vs. training set size, by repeated subsampling
+"""
+
+def main():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    config_path = argv[1]
+    config_data = configData(config_path)
+
+    features = read_features(config_data.feature_path, config_data.bad_cohorts, config_data.bad_batches,
+                             use_cache=getattr(config_data, "feature_cache", False))
+    logging.info("Read %d samples with features.", features.shape[0])
+    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, config_data.cancer_type, config_data.maf_key,
+                                                use_cache=getattr(config_data, "count_cache", False))
+    logging.info("Loaded %d %s/normal data in %d regions.", mcm_data.shape[0], config_data.cancer_type, len(raw_regions))
+
+    # fixed holdout, stratified by cancer type
+    holdout_fraction = getattr(config_data, "holdout_fraction", 0.3)
+    dt_holdout = mcm_data.groupby("cancer_type", group_keys=False).apply(
+        lambda d: d.sample(frac=holdout_fraction, random_state=config_data.iteration_start_seed))
+    dt_train = mcm_data[~mcm_data.index.isin(dt_holdout.index)]
+    logging.info("Training pool %d, holdout %d.", dt_train.shape[0], dt_holdout.shape[0])
+
+    engine = subsampleEngine(config_data)
+    engine.set_data(dt_train, dt_holdout, raw_regions, config_data.iteration_start_seed)
+    summary = engine.run(config_data.subsample_sizes, config_data.subsample_reps, config_data.iteration_start_seed,
+                         config_data.output_prefix, getattr(config_data, "num_workers", 1))
+    print(summary.to_csv(sep='\t', index=False), end='')
+
+
+if __name__ == "__main__":
+    main()
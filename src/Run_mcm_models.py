@@ -1,14 +1,14 @@
 #!/usr/bin/env python3
 
 import logging
-import json
-from sys import argv
-from typing import final
+import argparse
 from Classifier import regData
 from configData import configData
-from subprocess import check_call
+from quantBootstrap import run_quant_bootstrap
+from cvScheduler import cvScheduler
 
-from dataInterface import read_features, load_molcounts_data, set_roc, convert_roc_map_to_dataframe
+from dataInterface import read_features, load_molcounts_data, set_roc, convert_roc_map_to_dataframe, resultWriter, \
+    print_result_summary, save_iteration_checkpoint, load_iteration_checkpoint, write_filter_stats
 
 """
 Gateway of running simulation & prediction & modeling
@@ -18,22 +18,110 @@ def main():
     logging.basicConfig()
     logging.getLogger().setLevel(logging.INFO)
 
-    config_path = argv[1]
-    config_data = configData(config_path)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_paths", nargs='+')
+    parser.add_argument("--resume", action="store_true", help="skip seeds already stored in the checkpoint directory")
+    parser.add_argument("--shard-index", type=int, default=0)
+    parser.add_argument("--shard-count", type=int, default=1,
+                        help="with >1 shards only checkpoints are written; combine them with Merge-shards.py")
+    args = parser.parse_args()
+    if args.shard_index < 0 or args.shard_index >= args.shard_count:
+        raise Exception("Shard index %d out of range for %d shards." % (args.shard_index, args.shard_count))
 
-    features = read_features(config_data.feature_path, config_data.bad_cohorts, config_data.bad_batches)
+    config_list = [configData(p) for p in args.config_paths]
+    shard_tasks = get_shard_tasks(config_list, args.shard_index, args.shard_count)
+    for config_idx, config_data in enumerate(config_list):
+        cv_indexes = [cv_idx for (cidx, cv_idx) in shard_tasks if cidx == config_idx]
+        if len(cv_indexes) == 0:
+            continue
+        run_config(config_data, cv_indexes, args.resume, write_final=(args.shard_count == 1))
+
+
+def get_shard_tasks(config_list, shard_index, shard_count):
+    """
+    all (config, iteration) pairs of the study, dealt round-robin to shards
+    """
+    all_tasks = []
+    for config_idx, config_data in enumerate(config_list):
+        for cv_idx in range(config_data.total_iterations):
+            all_tasks.append((config_idx, cv_idx))
+    return all_tasks[shard_index::shard_count]
+
+
+def run_config(config_data, cv_indexes, resume, write_final):
+    checkpoint_dir = get_checkpoint_dir(config_data)
+
+    features = read_features(config_data.feature_path, config_data.bad_cohorts, config_data.bad_batches,
+                             use_cache=getattr(config_data, "feature_cache", False))
     logging.info("Read %d samples with features.", features.shape[0])
-    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, config_data.cancer_type, config_data.maf_key)
+    mcm_data, raw_regions = load_molcounts_data(config_data.count_path, features, config_data.cancer_type, config_data.maf_key,
+                                                use_cache=getattr(config_data, "count_cache", False))
     logging.info("Loaded %d %s/normal data in %d regions.", mcm_data.shape[0], config_data.cancer_type, len(raw_regions))
 
     logging.info("Start CV.")
+    writer = resultWriter(config_data.output_prefix, getattr(config_data, "partial_output_format", None),
+                          getattr(config_data, "pred_format", "tsv"))
+    iter_results = []
+    loaded = {}
+    if resume:
+        for cv_idx in cv_indexes:
+            shuffle_seed = config_data.iteration_start_seed + cv_idx
+            iter_result = load_iteration_checkpoint(checkpoint_dir, config_data, shuffle_seed)
+            if iter_result is not None:
+                loaded[cv_idx] = iter_result
+                logging.info("Loaded iteration #%d (seed %d) from checkpoint.", cv_idx, shuffle_seed)
+
+    def save_result(shuffle_seed, iter_result):
+        # checkpoint as soon as a seed is done, so a preempted run keeps it
+        cv_idx = shuffle_seed - config_data.iteration_start_seed
+        save_iteration_checkpoint(checkpoint_dir, config_data, shuffle_seed, iter_result)
+        writer.write_iteration(cv_idx, iter_result[1], iter_result[0], iter_result[2])
+        logging.info("Finished iteration #%d.", cv_idx)
+
+    # filter statistics do not depend on the seed: written once per config, by the run (or shard) owning iteration 0
+    write_stats = 0 in cv_indexes
+    scheduled = {}
+    if getattr(config_data, "cv_mode", None) is not None:
+        scheduled = run_scheduled_iterations(mcm_data, raw_regions, config_data,
+                                             [config_data.iteration_start_seed + i for i in cv_indexes if i not in loaded],
+                                             write_stats, save_result)
+        write_stats = write_stats and len(scheduled) == 0
+    for cv_idx in cv_indexes:
+        shuffle_seed = config_data.iteration_start_seed + cv_idx
+        if cv_idx in loaded:
+            iter_results.append(loaded[cv_idx])
+            continue
+        if shuffle_seed in scheduled:
+            iter_results.append(scheduled[shuffle_seed])
+            continue
+        iter_result = run_single_iteration(mcm_data, raw_regions, config_data, shuffle_seed, write_stats)
+        write_stats = False
+        save_result(shuffle_seed, iter_result)
+        iter_results.append(iter_result)
+    if write_stats: # every iteration came from checkpoints
+        write_filter_stats(config_data.output_prefix, get_filter_stats(mcm_data, raw_regions, config_data))
+
+    if write_final:
+        final_roc, final_r2, final_pred, final_metrics = merge_iteration_results(iter_results, config_data)
+        writer.dump_prediction_result(final_roc, final_r2, final_pred, final_metrics)
+        print_result_summary(final_roc, final_r2)
+    writer.close()
+
+
+def get_checkpoint_dir(config_data):
+    return getattr(config_data, "checkpoint_dir", config_data.output_prefix + ".ckpt")
+
+
+def merge_iteration_results(iter_results, config_data):
+    """
+    combine (r2, roc, pred, metrics) of iterations, in iteration order, into final roc, r2, pred and metrics
+    """
     roc_map = {}
     final_r2 = None
     final_pred = None
     final_metrics = []
-    for cv_idx in range(config_data.total_iterations):
-        shuffle_seed = config_data.iteration_start_seed + cv_idx
-        r2_result, roc_result, pred_dataframe, out_metrics = run_single_iteration(mcm_data, raw_regions, config_data, shuffle_seed)
+    for cv_idx, (r2_result, roc_result, pred_dataframe, out_metrics) in enumerate(iter_results):
+        pred_dataframe = pred_dataframe.copy()
         set_roc(roc_map, roc_result, num_digits=config_data.num_digits-1)
         if cv_idx == 0:
             final_r2 = r2_result
@@ -49,38 +137,87 @@ def main():
             pred_dataframe.columns = ["pred" + str(cv_idx), "train" + str(cv_idx)]
             final_pred = final_pred.merge(pred_dataframe, how='outer', left_index=True, right_index=True)
         final_metrics.append(out_metrics)
-        logging.info("Finished iteration #%d.", cv_idx)
 
     final_roc = convert_roc_map_to_dataframe(roc_map, config_data.num_digits)
-    final_roc.to_csv(config_data.output_prefix + ".roc.tsv", sep='\t', index=False)
-    if not config_data.binary:
-        final_r2.to_csv(config_data.output_prefix + ".r2.tsv", sep='\t', index=True)
+    if config_data.binary:
+        final_r2 = None
     final_pred = final_pred.round(config_data.num_digits)
-    final_pred.to_csv(config_data.output_prefix + ".pred.tsv", sep='\t', index=True)
-    outfile = open(config_data.output_prefix + ".metrics.json", 'w')
-    json.dump(final_metrics, outfile)
-    outfile.close()
+    return final_roc, final_r2, final_pred, final_metrics
+
+
+def get_filter_stats(mcm_data, raw_regions, config_data):
+    """
+    filter statistics of a config without fitting, for runs whose iterations all come from checkpoints
+    """
+    reg_data = regData(config_data)
+    reg_data.set_cv_data(mcm_data, raw_regions, config_data.iteration_start_seed)
+    return reg_data.get_filter_stats()
+
 
-    if not config_data.binary:
-        check_call("cat " + config_data.output_prefix + ".r2.tsv", shell=True)
-    cmd = "cat " + config_data.output_prefix + ".roc.tsv | awk '$1>=0.95' | head -n 2"
-    check_call(cmd, shell=True)
+def run_scheduled_iterations(mcm_data, raw_regions, config_data, cv_seeds, write_stats=False, on_result=None):
+    """
+    all iterations' (repeat, fold) fits from cvScheduler in one task pool; return {seed: iteration result}
+    on_result(seed, iteration result) is called as each seed finishes
+    """
+    if len(cv_seeds) == 0:
+        return {}
+    scheduler = cvScheduler(config_data)
+    scheduler.set_data(mcm_data, raw_regions)
+    if write_stats:
+        write_filter_stats(config_data.output_prefix, scheduler.pool_reg.get_filter_stats())
+    iter_results = {}
 
+    def set_result(seed, holder):
+        iter_results[seed] = get_iteration_result(holder, config_data, seed)
+        if on_result is not None:
+            on_result(seed, iter_results[seed])
 
-def run_single_iteration(mcm_data, raw_regions, config_data, cv_seed):
+    scheduler.run(cv_seeds, getattr(config_data, "num_workers", 1), set_result)
+    return iter_results
+
+
+def run_single_iteration(mcm_data, raw_regions, config_data, cv_seed, write_stats=False):
     reg_data = regData(config_data)
     reg_data.set_cv_data(mcm_data, raw_regions, cv_seed)
     logging.info("Set %d fold CV data with %d in each partition.", reg_data.num_cv_, reg_data.test_x[0].shape[0])
 
+    if write_stats:
+        write_filter_stats(config_data.output_prefix, reg_data.get_filter_stats())
+
     reg_data.run_cv_maf_predict()
     logging.info("Finished set up model with %d follow up iteration.", reg_data.follow_iter_)
-    
+    return get_iteration_result(reg_data, config_data, cv_seed)
+
+
+def get_iteration_result(reg_data, config_data, cv_seed):
+    """
+    (r2, roc, pred, metrics) of one iteration from the predictions of reg_data
+    """
     roc_result = reg_data.get_roc()
     if config_data.binary:
         r2_result = None
     else:
         r2_result = reg_data.get_r2_stats_dataframe(0.95)
     pred_dataframe = reg_data.get_per_sample_logit_mafs()
+    num_bootstraps = getattr(config_data, "num_bootstraps", 0)
+    if num_bootstraps > 0:
+        roc_ci = reg_data.get_roc_confidence([0.95, 0.98], num_bootstraps, cv_seed)
+        reg_data.output_metrics["roc_ci"] = roc_ci.to_dict(orient="records")
+    num_quant_bootstraps = getattr(config_data, "num_quant_bootstraps", 0)
+    if num_quant_bootstraps > 0:
+        if config_data.binary:
+            logging.warning("num_quant_bootstraps only applies to quantitative models - skipped.")
+        else:
+            if not reg_data.test_x: # predictions from the CV scheduler carry no fold matrices
+                logging.warning("num_quant_bootstraps is not supported with cv_mode - skipped.")
+                return r2_result, roc_result, pred_dataframe, reg_data.output_metrics
+            boot_table = run_quant_bootstrap(reg_data, num_quant_bootstraps, cv_seed, getattr(config_data, "num_workers", 1))
+            boot_table.to_csv("%s.seed%d.bootstrap.tsv" % (config_data.output_prefix, cv_seed), sep='\t',
+                              index_label="samples")
+            boot_sd = boot_table["boot_var"] ** 0.5
+            reg_data.output_metrics["quant_bootstrap"] = {"num_replicates": num_quant_bootstraps,
+                                                          "median_sd": round(boot_sd.median(), 4),
+                                                          "max_sd": round(boot_sd.max(), 4)}
     return r2_result, roc_result, pred_dataframe, reg_data.output_metrics
 
 
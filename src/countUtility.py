@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+from numpy import asarray, concatenate, log10, zeros
+
+
+def get_region_lengths(region_list):
+    """
+    region length from ids like chr_start_stop; ctrl_sum counted as 11000
+    """
+    region_lens = zeros(len(region_list))
+    for i, k in enumerate(region_list):
+        if k == "ctrl_sum":
+            region_lens[i] = 11000
+        else:
+            ks = k.split('_')
+            region_lens[i] = int(ks[2]) - int(ks[1])
+    return region_lens
+
+
+def get_trim_masks(counts, ctrl_sums, region_lens, by_pbinom, min_abs_mol_count, min_norm_mol_count):
+    """
+    counts: sample x region molecule counts
+    return (trim_mask, omit_mask): entries counted as zero, and entries to drop after normalization
+    """
+    if not by_pbinom:
+        trim_mask = counts < max(min_abs_mol_count, min_norm_mol_count)
+        omit_mask = trim_mask & (counts != 0)
+    else:
+        threshold = 1.5 / 100000000 * ctrl_sums.reshape(-1, 1) * (region_lens + 100)
+        trim_mask = counts < threshold
+        omit_mask = trim_mask
+    return trim_mask, omit_mask
+
+
+def get_mask_counts(trim_mask, omit_mask, num_workers=1, chunk_rows=2048):
+    """
+    per-sample trimmed & omitted region counts and per-region trimmed sample counts
+    reduced over row chunks in threads (numpy sums release the GIL)
+    """
+    def reduce_chunk(rstart):
+        trim_chunk = trim_mask[rstart:rstart+chunk_rows]
+        return trim_chunk.sum(axis=1), omit_mask[rstart:rstart+chunk_rows].sum(axis=1), trim_chunk.sum(axis=0)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        parts = list(pool.map(reduce_chunk, range(0, trim_mask.shape[0], chunk_rows)))
+    if len(parts) == 0:
+        return zeros(0, dtype=int), zeros(0, dtype=int), zeros(trim_mask.shape[1], dtype=int)
+    return concatenate([p[0] for p in parts]), concatenate([p[1] for p in parts]), sum(p[2] for p in parts)
+
+
+def log_normalize(counts, ctrl_sums, x_offset):
+    return log10(counts / ctrl_sums.reshape(-1, 1) + x_offset)
+
+
+def normalize_counts(counts, ctrl_sums, region_lens, params):
+    """
+    log-normalized counts and their trimmed copy, with the trim & omit masks
+    params: regData, or any object with x_offset_, region_filter_by_pbinom, min_abs_mol_count, min_norm_mol_count, min_omit_coef
+    return (norm_x, trimmed_x, trim_mask, omit_mask): norm_x is used for training, trimmed_x for test samples
+    """
+    counts = asarray(counts, dtype=float)
+    ctrl_sums = asarray(ctrl_sums, dtype=float)
+    trim_mask, omit_mask = get_trim_masks(counts, ctrl_sums, region_lens, params.region_filter_by_pbinom,
+                                          params.min_abs_mol_count, params.min_norm_mol_count)
+    norm_x = log_normalize(counts, ctrl_sums, params.x_offset_)
+    trimmed_x = norm_x.copy()
+    trimmed_x[trim_mask] = log10(params.x_offset_)
+    if params.min_omit_coef:
+        trimmed_x[omit_mask] = 0
+    return norm_x, trimmed_x, trim_mask, omit_mask
+
+
+def normalize_sample_counts(counts, ctrl_sums, region_lens, params):
+    """
+    trimmed log-normalized counts as used for test samples in regData
+    """
+    return normalize_counts(counts, ctrl_sums, region_lens, params)[1]
@@ -0,0 +1,178 @@
+import logging
+from resource import getrusage, RUSAGE_SELF
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from numpy import asarray, concatenate, nonzero, random, zeros, arange
+from Classifier import regData
+from mafUtility import get_linear_scorer, predOutcome
+
+
+# normalized sample pool shared with worker processes, set once per worker
+_pool_data = None
+
+
+def _init_worker(pool_data):
+    global _pool_data
+    _pool_data = pool_data
+
+
+def _fit_fold(config_data, seed, fold, init_train_locs, follow_train_locs, init_test_locs, follow_test_locs):
+    """
+    fit scaler, PCA & regressor on the training rows of one (repeat, fold), score its test & training rows
+    also return the worker's peak RSS (kB), as the parent's own rusage does not cover running workers
+    """
+    init_train, init_test, init_y, follow_train, follow_test, follow_y = _pool_data
+    reg = regData(config_data)
+    if len(follow_train_locs) > 0:
+        trained_model, scale_model, pca_model = reg.fit_model(init_train[init_train_locs], init_y[init_train_locs],
+                                                              follow_train[follow_train_locs], follow_y[follow_train_locs])
+    else:
+        trained_model, scale_model, pca_model = reg.fit_model(init_train[init_train_locs], init_y[init_train_locs])
+    scorer = get_linear_scorer(trained_model, scale_model, pca_model, init_train.shape[1])
+    test_y = scorer(concatenate((init_test[init_test_locs], follow_test[follow_test_locs])))
+    train_y = scorer(concatenate((init_train[init_train_locs], follow_train[follow_train_locs])))
+    num_comp = reg.output_metrics["num_components"][0] if reg.output_metrics["num_components"] else 0
+    return seed, fold, test_y, train_y, num_comp, getrusage(RUSAGE_SELF).ru_maxrss
+
+
+class cvScheduler():
+    """
+    all (repeat, fold) train/test index sets of a study, built up front over one normalized sample pool
+    folds are dealt within strata: cancer with MAF / cancer free / follow up, and with cv_mode "stratified"
+    also by cv_strata (cohort or batch); each repeat is a new permutation seeded by its iteration seed
+    """
+    def __init__(self, config_data):
+        self.config_data = config_data
+        self.num_folds = getattr(config_data, "num_cv", 4)
+        self.cv_mode = getattr(config_data, "cv_mode", "kfold")
+        self.strata_key = getattr(config_data, "cv_strata", "cohort")
+        if self.cv_mode not in ["kfold", "stratified"]:
+            raise Exception("Unknown cv_mode %s; known: kfold, stratified." % self.cv_mode)
+        self.pool_reg = None
+        self.pool_data = None
+        self.sample_names = [] # init then follow up, rows of the pool
+        self.num_init = 0
+        self.strata = None
+
+
+    def set_data(self, count_data, input_regions):
+        """
+        clean up & normalize all samples once, with regData's train (untrimmed) & test (trimmed) rules
+        """
+        pool_reg = regData(self.config_data)
+        pool_reg.num_cv_ = 1
+        pool_reg.scaler_ = None
+        pool_reg.do_transform_ = False
+        pool_reg.set_cv_data(count_data, input_regions, self.config_data.iteration_start_seed)
+        num_cols = len(pool_reg.model_regions)
+        if pool_reg.follow_train_x:
+            follow_train = asarray(pool_reg.follow_train_x[0], dtype=float)
+            follow_test = asarray(pool_reg.follow_test_x[0], dtype=float)
+            follow_y = asarray(pool_reg.follow_train_labels[0], dtype=float)
+            follow_names = pool_reg.follow_train_indexes[0]
+        else:
+            follow_train = zeros((0, num_cols))
+            follow_test = zeros((0, num_cols))
+            follow_y = zeros(0)
+            follow_names = []
+        self.pool_data = (asarray(pool_reg.init_train_x[0], dtype=float), asarray(pool_reg.test_x[0], dtype=float),
+                          asarray(pool_reg.init_train_y[0], dtype=float), follow_train, follow_test, follow_y)
+        self.sample_names = pool_reg.init_indexes[0] + follow_names
+        self.num_init = len(pool_reg.init_indexes[0])
+
+        sample_table = pool_reg.sample_table.loc[self.sample_names]
+        strata = sample_table["group"].astype(str) + "_" + sample_table["cancer_status"].astype(str)
+        if self.cv_mode == "stratified":
+            strata = strata + "_" + count_data.loc[self.sample_names, self.strata_key].astype(str)
+        self.strata = strata.values
+        self.pool_reg = pool_reg
+        logging.info("CV pool: %d with MAF, %d follow ups in %d strata.", self.num_init, len(follow_names),
+                     len(set(self.strata)))
+
+
+    def get_fold_ids(self, seed):
+        """
+        fold of each pool sample for one repeat; folds take turns within each stratum
+        """
+        rng = random.default_rng(seed)
+        fold_ids = zeros(len(self.sample_names), dtype=int)
+        offset = 0
+        for stratum in sorted(set(self.strata)):
+            members = rng.permutation(nonzero(self.strata == stratum)[0])
+            fold_ids[members] = (offset + arange(len(members))) % self.num_folds
+            offset += len(members)
+        return fold_ids
+
+
+    def get_tasks(self, seeds):
+        """
+        (seed, fold, init train rows, follow train rows, init test rows, follow test rows) of every repeat
+        """
+        tasks = []
+        for seed in seeds:
+            fold_ids = self.get_fold_ids(seed)
+            for fold in range(self.num_folds):
+                is_test = fold_ids == fold
+                test_locs = nonzero(is_test)[0]
+                train_locs = nonzero(~is_test)[0]
+                tasks.append((seed, fold, train_locs[train_locs < self.num_init],
+                              train_locs[train_locs >= self.num_init] - self.num_init,
+                              test_locs[test_locs < self.num_init], test_locs[test_locs >= self.num_init] - self.num_init))
+        return tasks
+
+
+    def _get_result_holder(self):
+        # regData carrying predictions of one repeat, for the usual roc / r2 / per-sample outputs
+        holder = regData(self.config_data)
+        holder.num_cv_ = self.num_folds
+        holder.sample_table = self.pool_reg.sample_table.copy()
+        holder.pred_map = {k: predOutcome(v.true_y, v.cancer_status) for k, v in self.pool_reg.pred_map.items()}
+        for k in ["num_features_after_clean_up", "region_filtered(min, max, mean)", "memory_estimate_mb"]:
+            if k in self.pool_reg.output_metrics:
+                holder.output_metrics[k] = self.pool_reg.output_metrics[k]
+        holder.output_metrics["num_components"] = [0] * self.num_folds
+        return holder
+
+
+    def run(self, seeds, num_workers=1, on_seed_done=None):
+        """
+        fit every (repeat, fold) in one process pool; return {seed: regData with that repeat's predictions}
+        on_seed_done(seed, holder) is called as soon as all folds of a seed are in, e.g. to checkpoint it
+        """
+        tasks = self.get_tasks(seeds)
+        task_names = {(t[0], t[1]): t for t in tasks}
+        holders = {seed: self._get_result_holder() for seed in seeds}
+        fold_results = {seed: {} for seed in seeds}
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(self.pool_data,)) as pool:
+            jobs = [pool.submit(_fit_fold, self.config_data, *t) for t in tasks]
+            for job in as_completed(jobs):
+                seed, fold, test_y, train_y, num_comp, worker_rss_kb = job.result()
+                fold_results[seed][fold] = (test_y, train_y, num_comp, worker_rss_kb)
+                if len(fold_results[seed]) == self.num_folds:
+                    self._set_seed_result(seed, holders[seed], fold_results.pop(seed), task_names)
+                    if on_seed_done is not None:
+                        on_seed_done(seed, holders[seed])
+        logging.info("Finished %d (repeat, fold) fits.", len(tasks))
+        return holders
+
+
+    def _set_seed_result(self, seed, holder, fold_results, task_names):
+        # predictions of one repeat, filled in fold order so that outputs do not depend on completion order
+        worker_rss_kb = 0
+        for fold in range(self.num_folds):
+            test_y, train_y, num_comp, fold_rss_kb = fold_results[fold]
+            worker_rss_kb = max(worker_rss_kb, fold_rss_kb)
+            _, _, init_train_locs, follow_train_locs, init_test_locs, follow_test_locs = task_names[(seed, fold)]
+            holder.output_metrics["num_components"][fold] = num_comp
+            test_names = self._get_names(init_test_locs, follow_test_locs)
+            for j in range(len(test_names)):
+                holder.pred_map[test_names[j]].test_y = test_y[j]
+            train_names = self._get_names(init_train_locs, follow_train_locs)
+            for j in range(len(train_names)):
+                holder.pred_map[train_names[j]].train_ys.append(train_y[j])
+        sample_locs = {k: j for j, k in enumerate(self.sample_names)}
+        holder.sample_table["fold"] = self.get_fold_ids(seed)[[sample_locs[k] for k in holder.sample_table.index]]
+        holder._set_peak_memory(worker_rss_kb)
+
+
+    def _get_names(self, init_locs, follow_locs):
+        return [self.sample_names[j] for j in init_locs] + [self.sample_names[self.num_init + j] for j in follow_locs]
@@ -1,37 +1,144 @@
 from statistics import median, mean
-from pandas import read_csv, merge, DataFrame
-from numpy import nan
+from pandas import read_csv, concat, merge, DataFrame
+from numpy import nan, array, save, load, savez_compressed, isin, ravel, dot, asfortranarray
+from queue import Queue
+from threading import Thread
 import json
+import os
+import pickle
 
 
-def read_features(feature_path, bad_cohorts, bad_batches):
+def _load_feature_table(feature_path, use_cache):
+    """
+    feature table indexed by sample_id, with categorical cohort (merged names), batch & cancer_type
+    with use_cache the table is pickled next to feature_path and reused while newer than it
+    """
+    cache_path = feature_path + ".features.pkl"
+    if use_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(feature_path):
+        infile = open(cache_path, 'rb')
+        features = pickle.load(infile)
+        infile.close()
+        return features
+
     features = read_csv(feature_path, sep='\t', header=0)
+    # merge cohort names: mapped once per category, not per sample
+    cohorts = features["cohort"].astype("category")
+    cohort_map = {r: r.split('_')[0] for r in cohorts.cat.categories}
+    features["cohort"] = cohorts.map(cohort_map).astype("category")
+    for k in ["batch", "cancer_type"]:
+        features[k] = features[k].astype("category")
+    features.index = features["sample_id"].to_list()
+
+    if use_cache:
+        outfile = open(cache_path, 'wb')
+        pickle.dump(features, outfile)
+        outfile.close()
+    return features
+
 
-    # merge cohort names
-    raw_names = list(set(features.cohort.to_list()))
-    cohort_map = {}
-    for r in raw_names:
-        cohort_map[r] = r.split('_')[0]
-        
+def _get_category_mask(values, names):
+    # rows whose category is in names, by category codes
+    name_codes = values.cat.categories.get_indexer(list(names))
+    return isin(values.cat.codes.values, name_codes[name_codes >= 0])
+
+
+def read_features(feature_path, bad_cohorts, bad_batches, use_cache=False):
+    features = _load_feature_table(feature_path, use_cache)
     print(f"original features for {features.shape[0]} samples.")
-    features = features.replace({"cohort": cohort_map})
-    features = features[~features.cohort.isin(bad_cohorts)]
-    features = features[~features.batch.isin(bad_batches)]
+    bad_rows = _get_category_mask(features["cohort"], bad_cohorts) | _get_category_mask(features["batch"], bad_batches)
+    features = features[~bad_rows]
     print(f"keep features for {features.shape[0]} samples.")
     return features
 
 
-def load_molcounts_data(fname, features, cancer_name, maf_key):
-    mdata = read_csv(fname, sep='\t', header=0)
-    mdata = mdata.T
-    mdata.columns = mdata.iloc[0].to_list()
-    mdata = mdata.iloc[1:]
-    region_list = mdata.columns.to_list()
-    region_list.remove("ctrl_sum")
+def _get_cache_paths(fname):
+    return fname + ".counts.npy", fname + ".counts.index.json"
+
+
+def build_molcounts_cache(fname):
+    """
+    store the count matrix as a region-major binary matrix, so that a region subset is a set of contiguous rows
+    """
+    mdata = read_csv(fname, sep='\t', header=0, index_col=0)
+    matrix_path, index_path = _get_cache_paths(fname)
+    save(matrix_path, mdata.values.astype('int64'))
+    outfile = open(index_path, 'w')
+    json.dump({"regions": mdata.index.to_list(), "samples": mdata.columns.to_list()}, outfile)
+    outfile.close()
+
+
+def _has_valid_cache(fname):
+    matrix_path, index_path = _get_cache_paths(fname)
+    if not (os.path.exists(matrix_path) and os.path.exists(index_path)):
+        return False
+    return os.path.getmtime(matrix_path) >= os.path.getmtime(fname)
+
+
+def _read_cache_regions(fname):
+    if not _has_valid_cache(fname):
+        build_molcounts_cache(fname)
+    infile = open(_get_cache_paths(fname)[1], 'r')
+    regions = json.load(infile)["regions"]
+    infile.close()
+    regions.remove("ctrl_sum")
+    return regions
+
+
+def _read_region_rows(fname, region_subset, use_cache, chunk_size=5000):
+    """
+    read only the rows of given regions (+ ctrl_sum) from the region x sample count file
+    """
+    wanted = region_subset + ["ctrl_sum"]
+    if use_cache:
+        if not _has_valid_cache(fname):
+            build_molcounts_cache(fname)
+        matrix_path, index_path = _get_cache_paths(fname)
+        infile = open(index_path, 'r')
+        cache_index = json.load(infile)
+        infile.close()
+        row_map = {r: i for i, r in enumerate(cache_index["regions"])}
+        missing = [r for r in wanted if r not in row_map]
+        if missing:
+            raise Exception("%d model regions missing from count data, e.g. %s" % (len(missing), missing[0]))
+        counts = load(matrix_path, mmap_mode='r')
+        rows = array([row_map[r] for r in wanted])
+        return DataFrame(counts[rows], index=wanted, columns=cache_index["samples"])
+
+    wanted_set = set(wanted)
+    chunks = []
+    for dchunk in read_csv(fname, sep='\t', header=0, index_col=0, chunksize=chunk_size):
+        chunks.append(dchunk[dchunk.index.isin(wanted_set)])
+    mdata = chunks[0].append(chunks[1:])
+    missing = wanted_set - set(mdata.index)
+    if missing:
+        raise Exception("%d model regions missing from count data, e.g. %s" % (len(missing), sorted(missing)[0]))
+    return mdata.loc[wanted]
+
+
+def load_molcounts_data(fname, features, cancer_name, maf_key, region_subset=None, use_cache=False):
+    if region_subset is not None:
+        mdata = _read_region_rows(fname, region_subset, use_cache).T
+        region_list = list(region_subset)
+    else:
+        if use_cache:
+            mdata = _read_region_rows(fname, _read_cache_regions(fname), use_cache).T
+        else:
+            mdata = read_csv(fname, sep='\t', header=0)
+            mdata = mdata.T
+            mdata.columns = mdata.iloc[0].to_list()
+            mdata = mdata.iloc[1:]
+        region_list = mdata.columns.to_list()
+        region_list.remove("ctrl_sum")
     
-    extra_keys = [maf_key, "somatic_call", "cancer_type", "cohort", "stage", "sample_id"]
-    mdata = merge(mdata, features[extra_keys], left_index=True, right_on="sample_id")
-    mdata.index = mdata["sample_id"].to_list()
+    extra_keys = [maf_key, "somatic_call", "cancer_type", "cohort", "batch", "stage", "sample_id"]
+    if features.index.is_unique: # join on the sample_id index of features
+        sample_ids = mdata.index[mdata.index.isin(features.index)]
+        mdata = concat([mdata.loc[sample_ids], features.loc[sample_ids, extra_keys]], axis=1)
+    else: # one row per feature row of a sample, as merged before indexing
+        dup_ids = features.index[features.index.duplicated()].unique()
+        print(f"{len(dup_ids)} duplicated sample_id in features, e.g. {dup_ids[0]}: kept as separate rows.")
+        mdata = merge(mdata, features[extra_keys], left_index=True, right_on="sample_id")
+        mdata.index = mdata["sample_id"].to_list()
     
     mdata[maf_key] = mdata[maf_key].div(100)
     mdata = mdata.rename(columns = {maf_key: 'maf'})
@@ -45,6 +152,82 @@ def load_molcounts_data(fname, features, cancer_name, maf_key):
     return tumor_data, region_list
 
 
+def load_model_bundle(model_prefix):
+    """
+    return (predictor, scaler, transformer) pickled by Build-models.py
+    """
+    pickle_items = []
+    for suffix in ["predictor", "scaler", "transformer"]:
+        infile = open(model_prefix + "." + suffix + ".pkl", 'rb')
+        pcontent = pickle.load(infile)
+        pickle_items.append(pcontent)
+        infile.close()
+    return pickle_items
+
+
+def load_npz_model(npz_path, model_name=None):
+    """
+    one model of an npz bundle from Model-pickle-to-npz.py (first in model_list by default)
+    return (regions, weight, bias), weight & bias folded as in mafUtility.fold_linear_model
+    scores match the pickled model: bias comes from the raw intercept, not from _bias, which is shifted by the
+    98% specificity cutoff for LR models; bundles written before the raw intercept was stored keep that shift
+    """
+    with load(npz_path) as infile:
+        if model_name is None:
+            model_name = str(infile["model_list"][0])
+        regions = [str(r) for r in infile[model_name + "_region_id"]]
+        center = infile[model_name + "_center_offset"]
+        scale = infile[model_name + "_scale_offset"]
+        weight = infile[model_name + "_weight"] / scale
+        if model_name + "_raw_bias" in infile.files:
+            raw_bias = float(ravel(infile[model_name + "_raw_bias"])[0])
+        else:
+            raw_bias = float(ravel(infile[model_name + "_bias"])[0])
+            if model_name.endswith("lr"):
+                print("npz model %s has no raw intercept: scores are shifted by its 98%% specificity cutoff." % model_name)
+        bias = raw_bias - dot(center, weight)
+    return regions, weight, bias
+
+
+def write_model_regions(model_prefix, regions):
+    DataFrame(data={"region_id": regions}).to_csv(model_prefix + ".regions.tsv", sep='\t', index=False)
+
+
+def read_model_regions(model_prefix):
+    """
+    return the region list a model was trained on, or None for models built before it was recorded
+    """
+    region_path = model_prefix + ".regions.tsv"
+    if not os.path.exists(region_path):
+        return None
+    return read_csv(region_path, sep='\t', header=0)["region_id"].to_list()
+
+
+def write_model_history(model_prefix, history):
+    """
+    training summary for incremental updates (see modelUpdate.get_model_history): dict of fixed size arrays
+    """
+    savez_compressed(model_prefix + ".history.npz", **history)
+
+
+def read_model_history(model_prefix):
+    """
+    return the history dict written with the bundle, or None for models built before it was recorded
+    """
+    history_path = model_prefix + ".history.npz"
+    if not os.path.exists(history_path):
+        return None
+    with load(history_path) as infile:
+        return {k: infile[k] for k in infile.files}
+
+
+def write_filter_stats(output_prefix, filter_stats):
+    """
+    trim statistics of regData.get_filter_stats as <prefix>.filter_stats.npz, for QC without rerunning
+    """
+    savez_compressed(output_prefix + ".filter_stats.npz", **filter_stats)
+
+
 def set_roc(roc_map, reg_roc, num_digits):
     # add ROC result from one single run
     for idx, dt in reg_roc.iterrows():
@@ -68,12 +251,172 @@ def convert_roc_map_to_dataframe(roc_map, num_digits):
     return roc_result
 
 
-def dump_prediction_result(output_prefix, final_roc, final_r2, final_pred, final_metrics):
+def write_prediction_matrix(output_prefix, final_pred):
+    """
+    predictions as a column-major float64 <prefix>.pred.npy with samples & columns in <prefix>.pred.index.json
+    each column is contiguous on disk, so a memory-mapped read of a few columns touches only those
+    """
+    save(output_prefix + ".pred.npy", asfortranarray(final_pred.to_numpy(dtype=float, na_value=nan)))
+    outfile = open(output_prefix + ".pred.index.json", 'w')
+    json.dump({"samples": [str(k) for k in final_pred.index], "columns": [str(c) for c in final_pred.columns]}, outfile)
+    outfile.close()
+
+
+def read_prediction_matrix(output_prefix, columns=None):
+    """
+    DataFrame of the given prediction columns (all by default) from write_prediction_matrix output, via memory map
+    """
+    infile = open(output_prefix + ".pred.index.json", 'r')
+    pred_index = json.load(infile)
+    infile.close()
+    pred_matrix = load(output_prefix + ".pred.npy", mmap_mode='r')
+    if columns is None:
+        columns = pred_index["columns"]
+    col_locs = [pred_index["columns"].index(c) for c in columns]
+    return DataFrame(data={c: array(pred_matrix[:, j]) for c, j in zip(columns, col_locs)}, index=pred_index["samples"])
+
+
+def dump_prediction_result(output_prefix, final_roc, final_r2, final_pred, final_metrics, pred_format="tsv"):
+    """
+    pred_format: tsv, npy (write_prediction_matrix) or both
+    """
+    if pred_format not in ["tsv", "npy", "both"]:
+        raise Exception("Unknown prediction format %s." % pred_format)
     final_roc.to_csv(output_prefix + ".roc.tsv", sep='\t', index=False)
     if final_r2 is not None:
         final_r2.to_csv(output_prefix + ".r2.tsv", sep='\t', index=True)
-    final_pred.to_csv(output_prefix + ".pred.tsv", sep='\t', index=True)
+    if pred_format in ["tsv", "both"]:
+        final_pred.to_csv(output_prefix + ".pred.tsv", sep='\t', index=True)
+    if pred_format in ["npy", "both"]:
+        write_prediction_matrix(output_prefix, final_pred)
     outfile = open(output_prefix + ".metrics.json", 'w')
     json.dump(final_metrics, outfile)
     outfile.close()
 
+
+# config keys that change the result of a single seed; anything else (workers, caches, budgets, output
+# formats & paths) may differ between a run and its resume
+_checkpoint_keys = ["feature_path", "count_path", "cancer_type", "bad_cohorts", "bad_batches", "maf_key", "binary",
+                    "do_clean_up", "do_transform", "scaler_str", "regressor_str", "model_preset", "tumor_normal_ratio_min",
+                    "min_omit_coef", "min_abs_mol_count", "min_norm_mol_count", "region_filter_by_pbinom",
+                    "somatic_cleanup", "num_cv", "cv_mode", "cv_strata", "num_bootstraps", "num_quant_bootstraps"]
+
+
+def _get_checkpoint_key(config_data):
+    settings = {k: getattr(config_data, k) for k in _checkpoint_keys if hasattr(config_data, k)}
+    return json.dumps(settings, sort_keys=True)
+
+
+def save_iteration_checkpoint(checkpoint_dir, config_data, seed, iter_result):
+    """
+    iter_result: (r2, roc, pred, metrics) of one seed; written to a temp file first so a checkpoint is never partial
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    outpath = os.path.join(checkpoint_dir, "seed" + str(seed) + ".pkl")
+    outfile = open(outpath + ".tmp", 'wb')
+    pickle.dump({"config_key": _get_checkpoint_key(config_data), "seed": seed, "result": iter_result}, outfile)
+    outfile.close()
+    os.replace(outpath + ".tmp", outpath)
+
+
+def load_iteration_checkpoint(checkpoint_dir, config_data, seed):
+    """
+    return stored (r2, roc, pred, metrics) of the seed, or None if not done yet
+    """
+    inpath = os.path.join(checkpoint_dir, "seed" + str(seed) + ".pkl")
+    if not os.path.exists(inpath):
+        return None
+    infile = open(inpath, 'rb')
+    pcontent = pickle.load(infile)
+    infile.close()
+    if pcontent["config_key"] != _get_checkpoint_key(config_data):
+        raise Exception("Checkpoint %s was made with different settings." % inpath)
+    return pcontent["result"]
+
+
+def print_result_summary(final_roc, final_r2):
+    """
+    print R2 table and the first ROC point at >= 95% specificity
+    """
+    if final_r2 is not None:
+        print(final_r2.to_csv(sep='\t', index=True), end='')
+    print(final_roc[final_roc["specificity"] >= 0.95].head(1).to_csv(sep='\t', index=False), end='')
+
+
+def write_partial_result(output_prefix, cv_idx, roc_result, r2_result, pred_dataframe, out_format):
+    """
+    write result of a single iteration; out_format is one of tsv, tsv.gz, npz
+    """
+    iter_prefix = output_prefix + ".iter" + str(cv_idx)
+    if out_format == "npz":
+        pred_cols = [c for c in pred_dataframe.columns if c != "samples"]
+        arrays = {"samples": array(pred_dataframe["samples"], dtype=str), "pred_columns": array(pred_cols),
+                  "pred": pred_dataframe[pred_cols].astype(float).values,
+                  "roc": roc_result[["fpr", "tpr", "cutoff"]].astype(float).values}
+        if r2_result is not None:
+            arrays["r2"] = r2_result.astype(float).values
+            arrays["r2_index"] = array(r2_result.index, dtype=str)
+            arrays["r2_columns"] = array(r2_result.columns.to_list())
+        savez_compressed(iter_prefix + ".npz", **arrays)
+        return
+    if out_format not in ["tsv", "tsv.gz"]:
+        raise Exception("Unknown partial output format: %s" % out_format)
+    roc_result.to_csv(iter_prefix + ".roc." + out_format, sep='\t', index=False)
+    if r2_result is not None:
+        r2_result.to_csv(iter_prefix + ".r2." + out_format, sep='\t', index=True)
+    pred_dataframe.to_csv(iter_prefix + ".pred." + out_format, sep='\t', index=False)
+
+
+class resultWriter():
+    """
+    write result files from a background thread, so that output overlaps with the next iteration
+    """
+    def __init__(self, output_prefix, partial_format=None, pred_format="tsv"):
+        self.output_prefix = output_prefix
+        self.partial_format = partial_format # None: no per-iteration output
+        self.pred_format = pred_format
+        self.queue = Queue()
+        self.error = None
+        self.worker = Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            func, args = task
+            if self.error is not None: # stop writing after first failure
+                continue
+            try:
+                func(*args)
+            except Exception as e:
+                self.error = e
+
+
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+
+
+    def write_iteration(self, cv_idx, roc_result, r2_result, pred_dataframe):
+        # inputs are copied since callers keep modifying their frames
+        if self.partial_format is None:
+            return
+        r2_copy = r2_result.copy() if r2_result is not None else None
+        self.submit(write_partial_result, self.output_prefix, cv_idx, roc_result.copy(), r2_copy,
+                    pred_dataframe.copy(), self.partial_format)
+
+
+    def dump_prediction_result(self, final_roc, final_r2, final_pred, final_metrics):
+        self.submit(dump_prediction_result, self.output_prefix, final_roc, final_r2, final_pred, final_metrics, self.pred_format)
+
+
+    def close(self):
+        """
+        wait for all pending writes; raise the first write error if any
+        """
+        self.queue.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
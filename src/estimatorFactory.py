@@ -0,0 +1,90 @@
+import ast
+from functools import lru_cache
+from sklearn import linear_model, preprocessing
+
+"""
+Build scalers & regressors from config strings without eval
+"""
+
+estimator_registry = {
+    "preprocessing.RobustScaler": preprocessing.RobustScaler,
+    "preprocessing.StandardScaler": preprocessing.StandardScaler,
+    "preprocessing.MinMaxScaler": preprocessing.MinMaxScaler,
+    "preprocessing.MaxAbsScaler": preprocessing.MaxAbsScaler,
+    "linear_model.LogisticRegression": linear_model.LogisticRegression,
+    "linear_model.LinearRegression": linear_model.LinearRegression,
+    "linear_model.Ridge": linear_model.Ridge,
+    "linear_model.Lasso": linear_model.Lasso,
+    "linear_model.ElasticNet": linear_model.ElasticNet,
+}
+
+# named (scaler_str, regressor_str) combos
+model_presets = {
+    "robust_logistic": ("preprocessing.RobustScaler()", "linear_model.LogisticRegression()"),
+    "robust_linear": ("preprocessing.RobustScaler()", "linear_model.LinearRegression()"),
+    "standard_logistic": ("preprocessing.StandardScaler()", "linear_model.LogisticRegression()"),
+    "standard_linear": ("preprocessing.StandardScaler()", "linear_model.LinearRegression()"),
+}
+
+
+class estimatorSpec():
+    """
+    picklable recipe of an estimator: registry name & keyword params; build() gives a fresh unfitted estimator
+    """
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params # tuple of (key, value)
+
+
+    def build(self):
+        return estimator_registry[self.name](**dict(self.params))
+
+
+    def __repr__(self):
+        return "%s(%s)" % (self.name, ", ".join("%s=%r" % kv for kv in self.params))
+
+
+def _get_dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return _get_dotted_name(node.value) + "." + node.attr
+    raise Exception("Unsupported estimator expression.")
+
+
+@lru_cache(maxsize=None)
+def parse_estimator_str(estimator_str):
+    """
+    parse strings like "linear_model.LogisticRegression(C=0.5)": a registered name with literal keyword params
+    """
+    try:
+        tree = ast.parse(estimator_str.strip(), mode="eval").body
+        if not isinstance(tree, ast.Call) or tree.args:
+            raise Exception("Only keyword params are supported.")
+        name = _get_dotted_name(tree.func)
+        params = tuple((kw.arg, ast.literal_eval(kw.value)) for kw in tree.keywords)
+    except Exception as e:
+        raise Exception("Unable to parse estimator %s: %s" % (estimator_str, e))
+    if name not in estimator_registry:
+        raise Exception("Unknown estimator %s; known: %s" % (name, ", ".join(sorted(estimator_registry))))
+    spec = estimatorSpec(name, params)
+    try:
+        spec.build() # check params once
+    except TypeError as e:
+        raise Exception("Invalid params for %s: %s" % (name, e))
+    return spec
+
+
+def get_model_specs(params):
+    """
+    return (scaler spec or None, regressor spec) from model_preset, or scaler_str & regressor_str
+    """
+    preset = getattr(params, "model_preset", None)
+    if preset is not None:
+        if preset not in model_presets:
+            raise Exception("Unknown model preset %s; known: %s" % (preset, ", ".join(sorted(model_presets))))
+        scaler_str, regressor_str = model_presets[preset]
+    else:
+        scaler_str, regressor_str = params.scaler_str, params.regressor_str
+    scaler_spec = parse_estimator_str(scaler_str) if scaler_str else None
+    return scaler_spec, parse_estimator_str(regressor_str)
@@ -1,9 +1,8 @@
 from numpy.core.fromnumeric import transpose
-from sklearn import linear_model
+from sklearn import linear_model, preprocessing
 from scipy.special import logit
 from scipy import stats
-from copy import deepcopy
-from numpy import random, concatenate, quantile, matmul, transpose
+from numpy import random, concatenate, quantile, matmul, transpose, ones, zeros, ravel, sqrt, dot, asarray
 import logging
 
 
@@ -12,14 +11,15 @@ class singleRegModel():
     data struct for running a single regression test
     """
     def __init__(self, regressor):
-        self.regressor = regressor
+        self.regressor = regressor # estimatorSpec
         self.mmodel = None
+        self.follow_y_ = None # imputed targets of follow up samples in the last quant fit, kept for model updates
         # params
         self.quantile_limit_ = 0.95
 
 
     def train_binary(self, x_train, y_train):
-        self.mmodel = deepcopy(self.regressor)
+        self.mmodel = self.regressor.build()
         self.mmodel.fit(x_train, y_train)
 
 
@@ -38,8 +38,9 @@ class singleRegModel():
             x_merge = concatenate((init_x, follow_x))
             y_merge = concatenate((init_y, follow_y))
 
-            self.mmodel = deepcopy(self.regressor)
+            self.mmodel = self.regressor.build()
             self.mmodel.fit(x_merge, y_merge)
+        self.follow_y_ = follow_y
 
 
     def predict_prob(self, input_x):
@@ -55,13 +56,97 @@ class singleRegModel():
         #return probs
         return self.mmodel.predict(input_x)
 
-    
+
+
+def is_foldable(scale_model):
+    """
+    True if scale_model.transform is affine: a known scaler type without clipping
+    """
+    if scale_model is None:
+        return True
+    if isinstance(scale_model, preprocessing.MinMaxScaler):
+        return not scale_model.get_params().get("clip", False)
+    return isinstance(scale_model, (preprocessing.StandardScaler, preprocessing.RobustScaler, preprocessing.MaxAbsScaler))
+
+
+def _get_scaler_affine(scale_model, num_features):
+    """
+    (mult, offset) such that scale_model.transform(x) == x * mult + offset, honouring with_mean / with_std
+    (StandardScaler) and with_centering / with_scaling (RobustScaler); None if the scaler is not foldable
+    """
+    if not is_foldable(scale_model):
+        return None
+    mult = ones(num_features)
+    offset = zeros(num_features)
+    if scale_model is None:
+        return mult, offset
+    params = scale_model.get_params()
+    if isinstance(scale_model, preprocessing.MinMaxScaler):
+        return scale_model.scale_, scale_model.min_
+    if isinstance(scale_model, preprocessing.StandardScaler):
+        center = scale_model.mean_ if params["with_mean"] else None
+        scale = scale_model.scale_ if params["with_std"] else None
+    elif isinstance(scale_model, preprocessing.RobustScaler):
+        center = scale_model.center_ if params["with_centering"] else None
+        scale = scale_model.scale_ if params["with_scaling"] else None
+    else: # MaxAbsScaler
+        center = None
+        scale = scale_model.scale_
+    if scale is not None:
+        mult = 1 / scale
+    if center is not None:
+        offset = -center * mult
+    return mult, offset
+
+
+def fold_linear_model(trained_model, scale_model, pca_model, num_features):
+    """
+    fold scaler -> PCA -> linear model into one (weight, bias) on normalized counts
+    score = x . weight + bias matches predict_prob / predict_quant of trained_model
+    raise for scalers that are not affine (see is_foldable)
+    """
+    affine = _get_scaler_affine(scale_model, num_features)
+    if affine is None:
+        raise Exception("Scaler %s is not affine - scaler, PCA & model can not be folded." % scale_model)
+    coef = ravel(trained_model.mmodel.coef_)
+    bias = ravel(trained_model.mmodel.intercept_)[0]
+    if pca_model is not None:
+        if pca_model.whiten:
+            coef = coef / sqrt(pca_model.explained_variance_)
+        weight = dot(coef, pca_model.components_)
+        bias -= dot(pca_model.mean_, weight)
+    else:
+        weight = coef
+    mult, offset = affine
+    bias += dot(offset, weight)
+    return weight * mult, bias
+
+
+def get_linear_scorer(trained_model, scale_model, pca_model, num_features):
+    """
+    function of normalized count rows -> scores of trained_model after scaler & PCA
+    one folded dot product if the scaler is affine, else the transforms chained
+    """
+    if is_foldable(scale_model):
+        weight, bias = fold_linear_model(trained_model, scale_model, pca_model, num_features)
+        return lambda x: matmul(asarray(x, dtype=float), weight) + bias
+    coef = ravel(trained_model.mmodel.coef_)
+    bias = ravel(trained_model.mmodel.intercept_)[0]
+
+    def score_chained(x):
+        x = scale_model.transform(asarray(x, dtype=float))
+        if pca_model is not None:
+            x = pca_model.transform(x)
+        return matmul(x, coef) + bias
+    return score_chained
+
+
 class predOutcome():
     """
     store output for prediction
     """
-    def __init__(self):
-        self.true_y = None
+    def __init__(self, true_y=None, cancer_status=None):
+        self.true_y = true_y
         self.test_y = None
         self.train_ys = [] # with CV training can have multiple results
-        self.cancer_status = None # binary: 0 for normal and 1 for cancer
\ No newline at end of file
+        self.cancer_status = cancer_status # binary: 0 for normal and 1 for cancer
\ No newline at end of file
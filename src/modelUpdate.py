@@ -0,0 +1,382 @@
+from copy import deepcopy
+from numpy import array, asarray, concatenate, diag, dot, empty, eye, hstack, linalg, logaddexp, maximum, median, \
+    minimum, ones, percentile, quantile, sqrt, vstack, where, zeros
+from scipy.special import expit
+from sklearn import linear_model
+from sklearn.utils.extmath import svd_flip
+from mafUtility import singleRegModel, _get_scaler_affine
+
+"""
+Update a built model (scaler, PCA, regressor) with a new batch of training samples
+
+The bundle keeps a fixed size summary of its training data in the reduced (PCA) space, no samples:
+- gram: sum of za' za over training rows, za = [z, 1]; gives feature means & variances for the drift check
+- loss_quad, loss_lin: regressor training loss as 0.5 w' loss_quad w + loss_lin' w over w = [coef, intercept];
+  exact for least squares (X'X and -X'y), the quadratic (Laplace) approximation at the fit for logistic regression
+- init_quad, init_lin, quant_cap: the least squares part of samples with MAF and the follow up cap, quantitative only
+An update merges the new batch into the scaler & PCA statistics, carries the summary to the new basis
+((k+1) x (k+1) work) and fits the regressor on the batch rows plus the summary: time follows the batch size,
+not the number of samples seen. Follow up samples of earlier batches keep the targets imputed when they were added.
+"""
+
+
+def get_loss_kind(regressor_spec, is_binary):
+    """
+    ("least_squares", penalty) or ("logistic", penalty) when the regressor loss can be summarized, else None
+    penalty: weight lam of 0.5 * lam * |coef|^2 added to the loss (Ridge alpha, 1 / C of LogisticRegression)
+    """
+    mmodel = regressor_spec.build()
+    params = mmodel.get_params()
+    if not params.get("fit_intercept", False):
+        return None
+    if type(mmodel) is linear_model.LinearRegression and not params["positive"]:
+        return "least_squares", 0.0
+    if type(mmodel) is linear_model.Ridge and not params["positive"]:
+        return "least_squares", float(params["alpha"])
+    if type(mmodel) is linear_model.LogisticRegression and is_binary and params["class_weight"] is None:
+        if params["penalty"] in (None, "none"):
+            return "logistic", 0.0
+        if params["penalty"] == "l2":
+            return "logistic", 1.0 / params["C"]
+    return None
+
+
+def _augment(z):
+    return hstack((z, ones((z.shape[0], 1))))
+
+
+def _get_penalty_matrix(size, penalty):
+    # penalty on coefficients only, not on the intercept
+    pmat = eye(size) * penalty
+    pmat[-1, -1] = 0
+    return pmat
+
+
+def _solve_least_squares(quad, lin, penalty):
+    return linalg.lstsq(quad + _get_penalty_matrix(quad.shape[0], penalty), -lin, rcond=None)[0]
+
+
+def _get_logistic_summary(za, y, weights, quad, lin):
+    """
+    quadratic approximation at weights of the logistic loss of rows za plus an existing summary
+    """
+    probs = expit(dot(za, weights))
+    hess = dot(za.T * (probs * (1 - probs)), za) + quad
+    grad = dot(za.T, probs - y) + dot(quad, weights) + lin
+    return hess, grad - dot(hess, weights)
+
+
+def _fit_logistic(za, y, quad, lin, penalty, max_iter=100, tol=1e-10):
+    """
+    Newton's method on the logistic loss of rows za, plus the summary (quad, lin) of earlier rows and the penalty
+    return (weights, loss_quad, loss_lin)
+    """
+    pmat = _get_penalty_matrix(quad.shape[0], penalty)
+
+    def get_objective(w):
+        scores = dot(za, w)
+        return (logaddexp(0, scores) - y * scores).sum() + 0.5 * dot(w, dot(quad + pmat, w)) + dot(lin, w)
+
+    weights = _solve_least_squares(quad, lin, penalty) # minimum of the summary alone: the previous fit
+    objective = get_objective(weights)
+    for i in range(max_iter):
+        probs = expit(dot(za, weights))
+        grad = dot(za.T, probs - y) + dot(quad + pmat, weights) + lin
+        hess = dot(za.T * (probs * (1 - probs)), za) + quad + pmat
+        step = linalg.lstsq(hess, grad, rcond=None)[0]
+        shrink = 1.0
+        while shrink > 1e-8 and get_objective(weights - shrink * step) > objective:
+            shrink /= 2
+        weights = weights - shrink * step
+        objective = get_objective(weights)
+        if abs(shrink * step).max() < tol:
+            break
+    loss_quad, loss_lin = _get_logistic_summary(za, y, weights, quad, lin)
+    return weights, loss_quad, loss_lin
+
+
+def _build_trained_model(regressor_spec, loss_kind, weights):
+    """
+    singleRegModel with an unfitted estimator from regressor_spec set to weights = [coef, intercept]
+    """
+    mmodel = regressor_spec.build()
+    if loss_kind == "logistic":
+        mmodel.coef_ = weights[:-1].reshape(1, -1)
+        mmodel.intercept_ = weights[-1:].copy()
+        mmodel.classes_ = array([0, 1])
+    else:
+        mmodel.coef_ = weights[:-1].copy()
+        mmodel.intercept_ = float(weights[-1])
+    mmodel.n_features_in_ = len(weights) - 1
+    srm = singleRegModel(regressor_spec)
+    srm.mmodel = mmodel
+    return srm
+
+
+def get_model_history(reg_data):
+    """
+    training summary of a regData after run_training in training only mode
+    the loss summary is left out for regressors without one (see get_loss_kind): such models are rebuilt, not updated
+    """
+    srm = reg_data.trained_model
+    init_za = _augment(asarray(reg_data.init_train_x[0], dtype=float))
+    init_y = asarray(reg_data.init_train_y[0], dtype=float)
+    if reg_data.follow_train_x:
+        follow_za = _augment(asarray(reg_data.follow_train_x[0], dtype=float))
+    else:
+        follow_za = empty((0, init_za.shape[1]))
+    init_quad = dot(init_za.T, init_za)
+    history = {"gram": init_quad + dot(follow_za.T, follow_za),
+               "feature_var": reg_data.train_feature_var if reg_data.train_feature_var is not None else empty(0)}
+
+    loss_kind = get_loss_kind(reg_data.regressor_, reg_data.is_binary_classifier_)
+    if loss_kind is None:
+        return history
+    weights = concatenate((asarray(srm.mmodel.coef_, dtype=float).ravel(),
+                           asarray(srm.mmodel.intercept_, dtype=float).ravel()))
+    if reg_data.is_binary_classifier_:
+        y = init_y
+        if follow_za.shape[0] > 0:
+            y = concatenate((init_y, asarray(reg_data.follow_train_labels[0], dtype=float)))
+        za = vstack((init_za, follow_za))
+        if loss_kind[0] == "logistic":
+            history["loss_quad"], history["loss_lin"] = _get_logistic_summary(za, y, weights, zeros(init_quad.shape),
+                                                                              zeros(len(weights)))
+        else:
+            history["loss_quad"], history["loss_lin"] = history["gram"], -dot(za.T, y)
+        return history
+
+    history["init_quad"] = init_quad
+    history["init_lin"] = -dot(init_za.T, init_y)
+    history["loss_quad"] = init_quad
+    history["loss_lin"] = history["init_lin"]
+    if follow_za.shape[0] > 0 and srm.follow_y_ is not None:
+        history["loss_quad"] = history["gram"]
+        history["loss_lin"] = history["init_lin"] - dot(follow_za.T, srm.follow_y_)
+    history["quant_cap"] = array([quantile(dot(init_za, weights), srm.quantile_limit_)])
+    return history
+
+
+def get_new_batch(reg_data, count_data, regions, shuffle_seed):
+    """
+    normalized (unscaled) training arrays of a new batch: (init_x, init_y, follow_x, follow_y)
+    """
+    reg_data.training_only = True
+    reg_data.scaler_ = None # scaler & PCA come from the bundle
+    reg_data.do_transform_ = False
+    reg_data.set_cv_data(count_data, regions, shuffle_seed)
+    init_x = asarray(reg_data.init_train_x[0], dtype=float)
+    init_y = asarray(reg_data.init_train_y[0], dtype=float)
+    if reg_data.follow_train_x:
+        follow_x = asarray(reg_data.follow_train_x[0], dtype=float)
+        follow_y = asarray(reg_data.follow_train_labels[0], dtype=float)
+    else:
+        follow_x = empty((0, init_x.shape[1]))
+        follow_y = empty(0)
+    return init_x, init_y, follow_x, follow_y
+
+
+def _reduce(x, scale_model, pca_model):
+    if scale_model is not None:
+        x = scale_model.transform(x)
+    if pca_model is not None:
+        x = pca_model.transform(x)
+    return x
+
+
+def get_drift(history, new_z):
+    """
+    largest shift of a reduced feature mean, new batch vs training history, in training standard deviations
+    """
+    gram = history["gram"]
+    num_seen = gram[-1, -1]
+    hist_mean = gram[-1, :-1] / num_seen
+    scale = sqrt(maximum(diag(gram)[:-1] / num_seen - hist_mean ** 2, 0))
+    scale = where(scale == 0, 1, scale)
+    return float((abs(new_z.mean(axis=0) - hist_mean) / scale).max())
+
+
+def update_scaler(scale_model, new_x, num_seen):
+    """
+    scaler including new_x: exact with partial_fit (standard, min-max, max-abs scalers)
+    RobustScaler has no running form - center & scale become sample weighted averages of old and batch values
+    """
+    if scale_model is None:
+        return None
+    scale_model = deepcopy(scale_model)
+    if hasattr(scale_model, "partial_fit"):
+        scale_model.partial_fit(new_x)
+        return scale_model
+    num_new = new_x.shape[0]
+    frac = num_new / (num_seen + num_new)
+    if scale_model.center_ is not None:
+        scale_model.center_ = (1 - frac) * scale_model.center_ + frac * median(new_x, axis=0)
+    if scale_model.scale_ is not None:
+        q_min, q_max = scale_model.quantile_range
+        batch_scale = percentile(new_x, q_max, axis=0) - percentile(new_x, q_min, axis=0)
+        batch_scale = where(batch_scale == 0, 1, batch_scale)
+        scale_model.scale_ = (1 - frac) * scale_model.scale_ + frac * batch_scale
+    return scale_model
+
+
+def get_scaled_map(old_scaler, new_scaler, num_features):
+    """
+    (ratio, shift) such that new_scaler.transform(x) == old_scaler.transform(x) * ratio + shift
+    """
+    old_mult, old_offset = _get_scaler_affine(old_scaler, num_features)
+    new_mult, new_offset = _get_scaler_affine(new_scaler, num_features)
+    ratio = new_mult / old_mult
+    return ratio, new_offset - old_offset * ratio
+
+
+def update_pca(pca_model, feature_var, num_seen, new_x, ratio, shift, total_explained_variance):
+    """
+    merge a scaled batch into the PCA basis, as in incremental PCA: SVD of the old weighted components,
+    the centered batch and the mean correction; old statistics are first carried to the new scaled space
+    return (pca model, per feature variance)
+    """
+    num_new = new_x.shape[0]
+    num_all = num_seen + num_new
+    old_mean = pca_model.mean_ * ratio + shift
+    new_mean = new_x.mean(axis=0)
+    mean_corr = sqrt(num_seen * num_new / num_all) * (old_mean - new_mean)
+    centered = new_x - new_mean
+    merged = vstack((pca_model.singular_values_.reshape(-1, 1) * pca_model.components_ * ratio, centered, mean_corr))
+    u, s, vt = linalg.svd(merged, full_matrices=False)
+    u, vt = svd_flip(u, vt)
+
+    feature_var = ((num_seen - 1) * feature_var * ratio ** 2 + (centered ** 2).sum(axis=0) + mean_corr ** 2) / (num_all - 1)
+    explained_var = s ** 2 / (num_all - 1)
+    var_ratio = explained_var / feature_var.sum()
+    total_var = 0
+    num_comp = 0
+    for v in var_ratio:
+        total_var += v
+        num_comp += 1
+        if total_var >= total_explained_variance:
+            break
+
+    new_pca = deepcopy(pca_model)
+    new_pca.n_components = num_comp
+    new_pca.n_components_ = num_comp
+    new_pca.components_ = vt[:num_comp]
+    new_pca.singular_values_ = s[:num_comp]
+    new_pca.explained_variance_ = explained_var[:num_comp]
+    new_pca.explained_variance_ratio_ = var_ratio[:num_comp]
+    new_pca.mean_ = (num_seen * old_mean + num_new * new_mean) / num_all
+    new_pca.n_samples_ = num_all
+    num_rest = len(feature_var) - num_comp
+    new_pca.noise_variance_ = (feature_var.sum() - explained_var[:num_comp].sum()) / num_rest if num_rest > 0 else 0.0
+    return new_pca, feature_var
+
+
+def get_basis_map(old_pca, new_pca, ratio, shift):
+    """
+    matrix carrying augmented reduced features to the new basis: [z_new, 1] == [z_old, 1] . basis
+    """
+    if old_pca is None:
+        rotate = diag(ratio)
+        offset = shift
+    else:
+        rotate = dot(old_pca.components_ * ratio, new_pca.components_.T)
+        offset = dot(old_pca.mean_ * ratio + shift - new_pca.mean_, new_pca.components_.T)
+    basis = zeros((rotate.shape[0] + 1, rotate.shape[1] + 1))
+    basis[:-1, :-1] = rotate
+    basis[-1, :-1] = offset
+    basis[-1, -1] = 1
+    return basis
+
+
+def carry_history(history, basis):
+    """
+    summary of history in the new basis: quadratic terms become basis' M basis, linear terms basis' v
+    """
+    carried = {}
+    for k, v in history.items():
+        if k.endswith("_quad") or k == "gram":
+            carried[k] = dot(basis.T, dot(v, basis))
+        elif k.endswith("_lin"):
+            carried[k] = dot(basis.T, v)
+        else:
+            carried[k] = v
+    return carried
+
+
+def _update_quant(history, init_za, init_y, follow_za, penalty, follow_iter, quantile_limit):
+    """
+    quant training of singleRegModel.train_quant on the summary plus new rows
+    the cap on imputed targets averages the stored cap and the cap of new samples with MAF, weighted by sample count
+    return (weights, history entries)
+    """
+    init_quad = history["init_quad"] + dot(init_za.T, init_za)
+    init_lin = history["init_lin"] - dot(init_za.T, init_y)
+    weights = _solve_least_squares(init_quad, init_lin, penalty)
+    follow_quad = history["loss_quad"] - history["init_quad"] + dot(follow_za.T, follow_za)
+    old_follow_lin = history["loss_lin"] - history["init_lin"]
+    num_old_init = history["init_quad"][-1, -1]
+    quant_cap = history["quant_cap"][0]
+    if init_za.shape[0] > 0:
+        batch_cap = quantile(dot(init_za, weights), quantile_limit)
+        quant_cap = (num_old_init * quant_cap + init_za.shape[0] * batch_cap) / init_quad[-1, -1]
+
+    loss_quad = init_quad
+    loss_lin = init_lin
+    if follow_quad[-1, -1] > 0 and follow_iter > 0:
+        loss_quad = init_quad + follow_quad
+        for i in range(follow_iter):
+            follow_y = minimum(dot(follow_za, weights), quant_cap)
+            loss_lin = init_lin + old_follow_lin - dot(follow_za.T, follow_y)
+            weights = _solve_least_squares(loss_quad, loss_lin, penalty)
+    return weights, {"init_quad": init_quad, "init_lin": init_lin, "loss_quad": loss_quad, "loss_lin": loss_lin,
+                     "quant_cap": array([quant_cap])}
+
+
+def update_model(reg_data, bundle, history, new_batch, drift_max_shift):
+    """
+    bundle: (trained model, scale model, pca model); history: get_model_history output with a loss summary;
+    new_batch: arrays from get_new_batch
+    return (trained model, scale model, pca model, history, drift); models are None when drift exceeds drift_max_shift
+    """
+    trained_model, scale_model, pca_model = bundle
+    init_x, init_y, follow_x, follow_y = new_batch
+    new_x = concatenate((init_x, follow_x))
+    num_seen = history["gram"][-1, -1]
+
+    drift = get_drift(history, _reduce(new_x, scale_model, pca_model))
+    if drift > drift_max_shift:
+        return None, None, None, history, drift
+
+    new_scaler = update_scaler(scale_model, new_x, num_seen)
+    ratio, shift = get_scaled_map(scale_model, new_scaler, new_x.shape[1])
+    scaled_x = new_scaler.transform(new_x) if new_scaler is not None else new_x
+    new_pca = None
+    feature_var = history["feature_var"]
+    if pca_model is not None:
+        new_pca, feature_var = update_pca(pca_model, feature_var, num_seen, scaled_x, ratio, shift,
+                                          reg_data.total_explained_variance_)
+
+    carried = carry_history(history, get_basis_map(pca_model, new_pca, ratio, shift))
+    init_za = _augment(_reduce(init_x, new_scaler, new_pca))
+    follow_za = _augment(_reduce(follow_x, new_scaler, new_pca))
+    new_history = {"gram": carried["gram"] + dot(init_za.T, init_za) + dot(follow_za.T, follow_za),
+                   "feature_var": feature_var}
+
+    loss_kind, penalty = get_loss_kind(reg_data.regressor_, reg_data.is_binary_classifier_)
+    if reg_data.is_binary_classifier_:
+        za = vstack((init_za, follow_za))
+        y = concatenate((init_y, follow_y))
+        if loss_kind == "logistic":
+            weights, loss_quad, loss_lin = _fit_logistic(za, y, carried["loss_quad"], carried["loss_lin"], penalty)
+        else:
+            loss_quad = carried["loss_quad"] + dot(za.T, za)
+            loss_lin = carried["loss_lin"] - dot(za.T, y)
+            weights = _solve_least_squares(loss_quad, loss_lin, penalty)
+        new_history["loss_quad"] = loss_quad
+        new_history["loss_lin"] = loss_lin
+    else:
+        weights, quant_history = _update_quant(carried, init_za, init_y, follow_za, penalty, reg_data.follow_iter_,
+                                               trained_model.quantile_limit_)
+        new_history.update(quant_history)
+
+    srm = _build_trained_model(reg_data.regressor_, loss_kind, weights)
+    return srm, new_scaler, new_pca, new_history, drift
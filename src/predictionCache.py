@@ -0,0 +1,94 @@
+import hashlib
+import sqlite3
+import time
+from numpy import ascontiguousarray
+
+
+def get_bundle_hash(model_prefix, params):
+    """
+    hash of the pickled bundle, its region list and the normalization params scores depend on
+    """
+    hasher = hashlib.sha1()
+    for suffix in [".predictor.pkl", ".scaler.pkl", ".transformer.pkl", ".regions.tsv"]:
+        try:
+            infile = open(model_prefix + suffix, 'rb')
+        except FileNotFoundError:
+            continue
+        hasher.update(infile.read())
+        infile.close()
+    norm_params = [params.min_omit_coef, params.min_abs_mol_count, params.min_norm_mol_count,
+                   params.region_filter_by_pbinom, params.binary]
+    hasher.update(repr(norm_params).encode())
+    return hasher.hexdigest()
+
+
+def get_sample_keys(bundle_hash, counts):
+    """
+    counts: sample x (model regions + control) molecule counts; one key per row
+    """
+    counts = ascontiguousarray(counts, dtype=float)
+    prefix = bundle_hash.encode()
+    return [hashlib.sha1(prefix + row.tobytes()).hexdigest() for row in counts]
+
+
+class predictionCache():
+    """
+    persistent sample scores in sqlite, keyed by (count vector, model bundle) hash
+    least recently used entries are dropped beyond max_entries
+    """
+    def __init__(self, db_path, max_entries=1000000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.num_hits = 0
+        self.num_misses = 0
+        self.batch_size_ = 500 # keys per query, below sqlite's variable limit
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS preds (key TEXT PRIMARY KEY, score REAL, last_used INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS preds_last_used ON preds (last_used)")
+        self.conn.commit()
+
+
+    def get_many(self, keys):
+        """
+        return {key: score} of cached keys, and mark them as used
+        """
+        found = {}
+        unique_keys = list(set(keys))
+        for bstart in range(0, len(unique_keys), self.batch_size_):
+            batch = unique_keys[bstart:bstart+self.batch_size_]
+            query = "SELECT key, score FROM preds WHERE key IN (%s)" % ",".join("?" * len(batch))
+            found.update(self.conn.execute(query, batch).fetchall())
+        now = time.time_ns()
+        self.conn.executemany("UPDATE preds SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+        self.conn.commit()
+        self.num_hits += sum(1 for k in keys if k in found)
+        self.num_misses += sum(1 for k in keys if k not in found)
+        return found
+
+
+    def put_many(self, key_scores):
+        now = time.time_ns()
+        self.conn.executemany("INSERT OR REPLACE INTO preds (key, score, last_used) VALUES (?, ?, ?)",
+                              [(k, float(v), now) for k, v in key_scores.items()])
+        self.conn.commit()
+        self._prune()
+
+
+    def _prune(self):
+        num_entries = self.get_size()
+        if num_entries > self.max_entries:
+            self.conn.execute("DELETE FROM preds WHERE key IN (SELECT key FROM preds ORDER BY last_used LIMIT ?)",
+                              (num_entries - self.max_entries,))
+            self.conn.commit()
+
+
+    def get_size(self):
+        return self.conn.execute("SELECT COUNT(*) FROM preds").fetchone()[0]
+
+
+    def get_stats(self):
+        return {"hits": self.num_hits, "misses": self.num_misses, "entries": self.get_size()}
+
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from numpy import array, percentile
+
+
+class predictionServer():
+    """
+    asyncio scoring service around a streamPredictor
+    concurrent single-sample requests are coalesced into micro-batches of up to max_batch_size, waiting at most
+    max_wait_ms after the first request of a batch, and scored with one vectorized call
+    protocol: one json per line, {"sample_id": ..., "counts": {region_id: count, ..., "ctrl_sum": count}} is answered
+    with {"sample_id": ..., "score": ...}; {"cmd": "stats"} with request count, latency percentiles & batch sizes
+    """
+    def __init__(self, predictor, max_batch_size=64, max_wait_ms=5.0, num_kept=10000):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.latencies = deque(maxlen=num_kept) # seconds, most recent requests
+        self.batch_sizes = deque(maxlen=num_kept)
+        self.num_requests = 0
+        self.queue = None
+
+
+    async def score(self, count_record):
+        """
+        score of one sample, None if it fails the control count filter
+        """
+        if not self.predictor.is_scorable(count_record):
+            return None
+        self.predictor.check_record(count_record) # before batching: a bad record must not fail its whole batch
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((count_record, future))
+        score = await future
+        self.latencies.append(time.perf_counter() - start)
+        self.num_requests += 1
+        return score
+
+
+    async def _get_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+
+    async def _run_batches(self):
+        while True:
+            batch = await self._get_batch()
+            try:
+                counts, ctrl_sums = self.predictor.get_count_matrix([b[0] for b in batch])
+                scores = self.predictor.score_counts(counts, ctrl_sums)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), score in zip(batch, scores):
+                if not future.done():
+                    future.set_result(float(score))
+            self.batch_sizes.append(len(batch))
+
+
+    def get_stats(self):
+        stats = {"num_requests": self.num_requests, "max_batch_size": self.max_batch_size,
+                 "max_wait_ms": self.max_wait * 1000}
+        if self.latencies:
+            lats = array(self.latencies) * 1000
+            stats["latency_ms"] = {"p50": percentile(lats, 50), "p90": percentile(lats, 90),
+                                   "p99": percentile(lats, 99), "max": lats.max()}
+            stats["mean_batch_size"] = sum(self.batch_sizes) / len(self.batch_sizes)
+        return stats
+
+
+    async def _answer(self, request, writer):
+        try:
+            if request.get("cmd") == "stats":
+                response = self.get_stats()
+            else:
+                response = {"sample_id": request.get("sample_id"), "score": await self.score(request["counts"])}
+        except Exception as e:
+            response = {"sample_id": request.get("sample_id"), "error": str(e)}
+        writer.write((json.dumps(response) + "\n").encode())
+
+
+    async def _handle_client(self, reader, writer):
+        # requests of one connection are answered as they finish, each answer carries its sample_id
+        tasks = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                writer.write(b'{"error": "invalid json"}\n')
+                continue
+            tasks.append(asyncio.create_task(self._answer(request, writer)))
+            tasks = [t for t in tasks if not t.done()]
+        await asyncio.gather(*tasks)
+        await writer.drain()
+        writer.close()
+
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self._run_batches())
+        server = await asyncio.start_server(self._handle_client, host, port)
+        logging.info("Serving predictions on %s:%d (batch <= %d, wait <= %.1f ms).", host, port,
+                     self.max_batch_size, self.max_wait * 1000)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
@@ -0,0 +1,79 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from numpy import asarray, random, zeros
+from mafUtility import singleRegModel, get_linear_scorer
+
+
+# per partition fold matrices shared with worker processes, set once per worker
+_fold_data = None
+
+
+def _init_worker(fold_data):
+    global _fold_data
+    _fold_data = fold_data
+
+
+def _fit_replicate(regressor, follow_iter, seed_seq):
+    """
+    one bootstrap replicate: in every partition resample init & follow up training rows with replacement,
+    rerun the follow up imputation and score the partition's test samples
+    return a dict of test sample name -> score (a duplicated name keeps its last score, as in pred_map)
+    """
+    rng = random.default_rng(seed_seq)
+    scores = {}
+    for init_x, init_y, follow_x, test_x, follow_test_x, test_names, follow_test_names, scale_model, pca_model in _fold_data:
+        init_locs = rng.integers(0, init_x.shape[0], init_x.shape[0])
+        srm = singleRegModel(regressor)
+        if follow_x is not None:
+            follow_locs = rng.integers(0, follow_x.shape[0], follow_x.shape[0])
+            srm.train_quant(init_x[init_locs], follow_x[follow_locs], init_y[init_locs], follow_iter)
+        else:
+            srm.train_quant(init_x[init_locs], None, init_y[init_locs], follow_iter)
+        scorer = get_linear_scorer(srm, scale_model, pca_model, test_x.shape[1])
+        scores.update(zip(test_names, scorer(test_x)))
+        if follow_test_x is not None:
+            scores.update(zip(follow_test_names, scorer(follow_test_x)))
+    return scores
+
+
+def get_fold_data(reg_data):
+    """
+    cached CV matrices of a regData after set_cv_data: training x already scaled & transformed per partition,
+    with the sample names of each partition's test rows
+    """
+    fold_data = []
+    for ii in range(reg_data.num_cv_):
+        has_follow = ii < len(reg_data.follow_train_x)
+        scale_model, pca_model = reg_data.get_fold_models(ii)
+        fold_data.append((asarray(reg_data.init_train_x[ii], dtype=float),
+                          asarray(reg_data.init_train_y[ii], dtype=float),
+                          asarray(reg_data.follow_train_x[ii], dtype=float) if has_follow else None,
+                          asarray(reg_data.test_x[ii], dtype=float),
+                          asarray(reg_data.follow_test_x[ii], dtype=float) if has_follow else None,
+                          reg_data.test_indexes[ii],
+                          reg_data.follow_test_indexes[ii] if has_follow else None,
+                          scale_model, pca_model))
+    return fold_data
+
+
+def run_quant_bootstrap(reg_data, num_bootstraps, seed, num_workers=1):
+    """
+    bootstrap the follow up MAF imputation of a quantitative regData over its existing CV partitions
+    replicate r uses the r-th child of SeedSequence(seed), so results do not depend on num_workers
+    return a copy of the sample table with pred (no resampling), boot_mean & boot_var of each test sample
+    """
+    seed_seqs = random.SeedSequence(seed).spawn(num_bootstraps)
+    sample_table = reg_data.sample_table.copy()
+    boot_scores = zeros((num_bootstraps, sample_table.shape[0]))
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                             initargs=(get_fold_data(reg_data),)) as pool:
+        jobs = [pool.submit(_fit_replicate, reg_data.regressor_, reg_data.follow_iter_, s) for s in seed_seqs]
+        for rep, job in enumerate(jobs):
+            rep_scores = job.result()
+            boot_scores[rep] = [rep_scores[k] for k in sample_table.index]
+    logging.info("Finished %d bootstrap replicates of the follow up imputation.", num_bootstraps)
+
+    sample_table["pred"] = [reg_data.pred_map[k].test_y for k in sample_table.index]
+    sample_table["boot_mean"] = boot_scores.mean(axis=0)
+    sample_table["boot_var"] = boot_scores.var(axis=0, ddof=1) if num_bootstraps > 1 else 0.0
+    return sample_table
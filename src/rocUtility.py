@@ -0,0 +1,97 @@
+from numpy import argsort, asarray, concatenate, cumsum, diff, nonzero, quantile, random, zeros, ones, arange
+from pandas import DataFrame
+
+
+class sortedScores():
+    """
+    scores sorted once (descending) with tie groups, so ROC curves for any sample weighting are cumulative sums
+    """
+    def __init__(self, labels, scores):
+        labels = asarray(labels, dtype=float)
+        scores = asarray(scores, dtype=float)
+        order = argsort(-scores, kind="mergesort")
+        self.scores = scores[order]
+        self.is_pos = labels[order] == 1
+        self.pos_locs = nonzero(self.is_pos)[0]
+        self.neg_locs = nonzero(~self.is_pos)[0]
+        # last position of each group of tied scores
+        self.group_ends = concatenate((nonzero(diff(self.scores))[0], [len(self.scores) - 1]))
+
+
+    def get_rates(self, weights):
+        """
+        weights: resample x sample counts in sorted order; return fpr, tpr (resample x threshold)
+        """
+        cum_tp = cumsum(weights * self.is_pos, axis=1)[:, self.group_ends]
+        cum_fp = cumsum(weights * ~self.is_pos, axis=1)[:, self.group_ends]
+        return cum_fp / cum_fp[:, -1:], cum_tp / cum_tp[:, -1:]
+
+
+    def get_roc(self):
+        """
+        exact fpr, tpr, cutoff at every distinct score
+        """
+        fpr, tpr = self.get_rates(ones((1, len(self.scores))))
+        return fpr[0], tpr[0], self.scores[self.group_ends]
+
+
+def get_auc(fpr, tpr):
+    """
+    trapezoid area of resample x threshold curves starting from (0, 0); ties count half as in Mann-Whitney
+    """
+    fpr = concatenate((zeros((fpr.shape[0], 1)), fpr), axis=1)
+    tpr = concatenate((zeros((tpr.shape[0], 1)), tpr), axis=1)
+    return (diff(fpr, axis=1) * (tpr[:, 1:] + tpr[:, :-1]) / 2).sum(axis=1)
+
+
+def get_sensitivity_at_specificity(fpr, tpr, spec_levels):
+    """
+    highest tpr with fpr <= 1 - spec, for each resample (row) and spec level (column)
+    """
+    sensis = zeros((fpr.shape[0], len(spec_levels)))
+    rows = arange(fpr.shape[0])
+    for j, spec in enumerate(spec_levels):
+        num_pass = (fpr <= 1 - spec + 1e-12).sum(axis=1)
+        sensis[:, j] = tpr[rows, (num_pass - 1).clip(min=0)] * (num_pass > 0)
+    return sensis
+
+
+def bootstrap_roc(labels, scores, spec_levels, num_bootstraps, seed, chunk_size=100):
+    """
+    stratified bootstrap of AUC and sensitivity at spec_levels from a single set of predictions
+    cancer and normal samples are resampled separately, chunk_size resamples at a time
+    return auc (num_bootstraps,), sensitivity (num_bootstraps x len(spec_levels))
+    """
+    ss = sortedScores(labels, scores)
+    rng = random.default_rng(seed)
+    num_pos = len(ss.pos_locs)
+    num_neg = len(ss.neg_locs)
+    aucs = []
+    sensis = []
+    for cstart in range(0, num_bootstraps, chunk_size):
+        num_resample = min(chunk_size, num_bootstraps - cstart)
+        weights = zeros((num_resample, len(ss.scores)))
+        weights[:, ss.pos_locs] = rng.multinomial(num_pos, ones(num_pos) / num_pos, size=num_resample)
+        weights[:, ss.neg_locs] = rng.multinomial(num_neg, ones(num_neg) / num_neg, size=num_resample)
+        fpr, tpr = ss.get_rates(weights)
+        aucs.append(get_auc(fpr, tpr))
+        sensis.append(get_sensitivity_at_specificity(fpr, tpr, spec_levels))
+    return concatenate(aucs), concatenate(sensis)
+
+
+def get_roc_confidence(labels, scores, spec_levels, num_bootstraps, seed, ci_level=0.95):
+    """
+    point estimate and percentile interval of AUC and sensitivity at each spec level
+    """
+    ss = sortedScores(labels, scores)
+    fpr, tpr, _ = ss.get_roc()
+    point_auc = get_auc(fpr.reshape(1, -1), tpr.reshape(1, -1))[0]
+    point_sensis = get_sensitivity_at_specificity(fpr.reshape(1, -1), tpr.reshape(1, -1), spec_levels)[0]
+    boot_aucs, boot_sensis = bootstrap_roc(labels, scores, spec_levels, num_bootstraps, seed)
+
+    qs = [(1 - ci_level) / 2, 1 - (1 - ci_level) / 2]
+    ci_result = DataFrame(data={"metric": [], "estimate": [], "lower": [], "upper": []})
+    ci_result.loc[0] = ["auc", point_auc] + list(quantile(boot_aucs, qs))
+    for j, spec in enumerate(spec_levels):
+        ci_result.loc[j + 1] = ["sensitivity_at_" + str(spec), point_sensis[j]] + list(quantile(boot_sensis[:, j], qs))
+    return ci_result
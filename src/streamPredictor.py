@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import time
+from numpy import asarray, zeros, nan, append
+from Classifier import regData
+from countUtility import get_region_lengths, normalize_sample_counts
+from predictionCache import get_sample_keys
+
+
+class streamPredictor():
+    """
+    score samples one at a time (or in small batches) with a trained model, without building CV data
+    """
+    def __init__(self, params, regions, scorer):
+        """
+        scorer: function of normalized count rows (in the order of regions) -> scores, e.g. get_linear_scorer for
+        pickled bundles: one folded dot product per sample for affine scalers, scaler & PCA chained otherwise
+        """
+        # reuse normalization params from regData so that scores match Run-prediction.py
+        self.reg_params = regData(params)
+        self.regions = regions
+        self.region_index = {r: i for i, r in enumerate(regions)}
+        self.region_lens = get_region_lengths(regions)
+        self.scorer = scorer
+        self.min_total_pos_ctrl_ = self.reg_params.min_total_pos_ctrl_
+        self.ctrl_key_ = self.reg_params.ctrl_key_
+        self.cache = None # predictionCache shared with Run-prediction.py
+        self.bundle_hash = None
+
+
+    def set_cache(self, cache, bundle_hash):
+        self.cache = cache
+        self.bundle_hash = bundle_hash
+
+
+    def check_record(self, count_record):
+        """
+        raise if a model region is missing: a zero count would silently change the score
+        """
+        missing = [r for r in self.regions if r not in count_record]
+        if missing:
+            raise Exception("Count record misses %d of %d model regions, e.g. %s." % (len(missing), len(self.regions),
+                                                                                      missing[0]))
+
+
+    def _to_count_vector(self, count_record):
+        self.check_record(count_record)
+        return asarray([count_record[r] for r in self.regions], dtype=float)
+
+
+    def score_counts(self, counts, ctrl_sums):
+        """
+        counts: sample x region matrix in the order of self.regions
+        """
+        return self.scorer(normalize_sample_counts(counts, ctrl_sums, self.region_lens, self.reg_params))
+
+
+    def get_count_matrix(self, count_records):
+        """
+        (sample x region counts, control sums) of count records, which should pass the control count filter
+        """
+        counts = zeros((len(count_records), len(self.regions)))
+        ctrl_sums = zeros(len(count_records))
+        for i, count_record in enumerate(count_records):
+            counts[i] = self._to_count_vector(count_record)
+            ctrl_sums[i] = count_record[self.ctrl_key_]
+        return counts, ctrl_sums
+
+
+    def is_scorable(self, count_record):
+        return count_record.get(self.ctrl_key_, 0) > self.min_total_pos_ctrl_
+
+
+    def score_sample(self, count_record):
+        """
+        count_record: dict of region -> molecule count, including the control key
+        return None for samples that fail the control count filter
+        """
+        if not self.is_scorable(count_record):
+            return None
+        counts, ctrl_sums = self.get_count_matrix([count_record])
+        if self.cache is None:
+            return self.score_counts(counts, ctrl_sums)[0]
+        key = get_sample_keys(self.bundle_hash, append(counts, ctrl_sums.reshape(-1, 1), axis=1))[0]
+        found = self.cache.get_many([key])
+        if key in found:
+            return found[key]
+        score = self.score_counts(counts, ctrl_sums)[0]
+        self.cache.put_many({key: score})
+        return score
+
+
+    def run(self, records, outstream):
+        """
+        records: iterable of (sample_id, count_record); write one score line per sample as it arrives
+        """
+        for sample_id, count_record in records:
+            try:
+                score = self.score_sample(count_record)
+            except Exception as e:
+                logging.error("Sample %s not scored: %s", sample_id, e)
+                score = nan
+            if score is None:
+                logging.warning("Sample %s has control count <= %d - not scored.", sample_id, self.min_total_pos_ctrl_)
+                score = nan
+            outstream.write("%s\t%s\n" % (sample_id, score))
+            outstream.flush()
+
+
+def read_json_records(instream):
+    """
+    one json per line: {"sample_id": ..., "counts": {region_id: count, ..., "ctrl_sum": count}}
+    """
+    for line in instream:
+        line = line.strip()
+        if not line:
+            continue
+        rec = json.loads(line)
+        yield rec["sample_id"], rec["counts"]
+
+
+def read_count_file(fpath):
+    """
+    per-sample count file with two tab-separated columns: region_id and count; header optional
+    """
+    count_record = {}
+    infile = open(fpath, 'r')
+    for line in infile:
+        items = line.rstrip('\n').split('\t')
+        if len(items) < 2:
+            continue
+        try:
+            count_record[items[0]] = float(items[1])
+        except ValueError: # header
+            continue
+    infile.close()
+    return count_record
+
+
+def watch_directory(dirpath, suffix=".tsv", poll_seconds=5.0):
+    """
+    yield per-sample count files as they show up in dirpath; sample id is the file name without suffix
+    files should be moved into dirpath once complete, so that a partial file is never read
+    """
+    seen = set()
+    while True:
+        new_files = sorted(f for f in os.listdir(dirpath) if f.endswith(suffix) and f not in seen)
+        for f in new_files:
+            seen.add(f)
+            yield f[:-len(suffix)], read_count_file(os.path.join(dirpath, f))
+        if not new_files:
+            time.sleep(poll_seconds)
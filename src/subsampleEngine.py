@@ -0,0 +1,161 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from numpy import argmax, argsort, asarray, concatenate, floor, nan, nonzero, random
+from pandas import DataFrame
+from Classifier import regData
+from mafUtility import get_linear_scorer
+from rocUtility import sortedScores, get_auc, get_sensitivity_at_specificity
+
+
+# training pool shared with worker processes, set once per worker
+_pool_data = None
+
+
+def _init_worker(pool_data):
+    global _pool_data
+    _pool_data = pool_data
+
+
+def _fit_subsample(config_data, size, rep, init_locs, follow_locs):
+    """
+    fit one model on rows of the shared pool and score the holdout
+    """
+    reg = regData(config_data)
+    init_x, init_y, follow_x, follow_y, x_test, test_status = _pool_data
+    if len(follow_locs) > 0:
+        trained_model, scale_model, pca_model = reg.fit_model(init_x[init_locs], init_y[init_locs],
+                                                              follow_x[follow_locs], follow_y[follow_locs])
+    else:
+        trained_model, scale_model, pca_model = reg.fit_model(init_x[init_locs], init_y[init_locs])
+    scores = get_linear_scorer(trained_model, scale_model, pca_model, x_test.shape[1])(x_test)
+
+    ss = sortedScores(test_status, scores)
+    fpr, tpr, _ = ss.get_roc()
+    fpr = fpr.reshape(1, -1)
+    tpr = tpr.reshape(1, -1)
+    sensis = get_sensitivity_at_specificity(fpr, tpr, [0.95, 0.98])[0]
+    num_comp = reg.output_metrics["num_components"][0] if reg.output_metrics["num_components"] else 0
+    return [size, rep, len(init_locs) + len(follow_locs), get_auc(fpr, tpr)[0], sensis[0], sensis[1], num_comp]
+
+
+def get_group_counts(size, group_sizes, num_required=0):
+    """
+    split size over groups in proportion to group_sizes (largest remainders get the extra rows)
+    the first num_required groups get at least one row each when they are not empty and the size allows
+    """
+    group_sizes = asarray(group_sizes)
+    exact = size * group_sizes / group_sizes.sum()
+    counts = floor(exact).astype(int)
+    counts[argsort(counts - exact, kind="stable")[:size - counts.sum()]] += 1
+    for g in range(num_required):
+        if counts[g] == 0 and group_sizes[g] > 0:
+            donor = argmax(counts)
+            if counts[donor] <= 1:
+                break
+            counts[donor] -= 1
+            counts[g] += 1
+    return counts
+
+
+class subsampleEngine():
+    """
+    learning curves: many training subsets of one normalized pool, each scored against a fixed holdout
+    """
+    def __init__(self, config_data):
+        self.config_data = config_data
+        self.pool_data = None
+        self.init_status = None # cancer status of pool rows with MAF, to draw both classes into every subset
+        self.result_columns = ["size", "rep", "num_train", "auc", "sens_at_0.95", "sens_at_0.98", "num_components"]
+
+
+    def set_data(self, dt_train, dt_holdout, input_regions, shuffle_seed):
+        """
+        normalize training pool & holdout once, with regData's train (untrimmed) & test (trimmed) rules
+        """
+        train_reg = regData(self.config_data)
+        train_reg.training_only = True
+        train_reg.scaler_ = None
+        train_reg.do_transform_ = False
+        train_reg.set_cv_data(dt_train, input_regions, shuffle_seed)
+        init_x = asarray(train_reg.init_train_x[0])
+        init_y = asarray(train_reg.init_train_y[0], dtype=float)
+        if train_reg.follow_train_x:
+            follow_x = asarray(train_reg.follow_train_x[0])
+            follow_y = asarray(train_reg.follow_train_labels[0], dtype=float)
+        else:
+            follow_x = init_x[:0]
+            follow_y = init_y[:0]
+
+        test_reg = regData(self.config_data)
+        test_reg.test_only = True
+        test_reg.scaler_ = None
+        test_reg.do_transform_ = False
+        test_reg.set_cv_data(dt_holdout, input_regions, shuffle_seed)
+        x_test, tlist = test_reg.get_test_matrix()
+        keep = [j for j in range(len(tlist)) if test_reg.pred_map[tlist[j]].cancer_status is not None]
+        test_status = asarray([test_reg.pred_map[tlist[j]].cancer_status for j in keep])
+        self.pool_data = (init_x, init_y, follow_x, follow_y, x_test[keep], test_status)
+        self.init_status = train_reg.sample_table["cancer_status"].reindex(train_reg.init_indexes[0]).values
+        logging.info("Subsampling pool: %d with MAF, %d follow ups; holdout %d.", init_x.shape[0], follow_x.shape[0], len(keep))
+
+
+    def get_subsample_tasks(self, sizes, num_reps, base_seed):
+        """
+        (size, rep, init rows, follow rows): cancer & cancer free rows with MAF and follow ups are sampled in
+        proportion, without replacement, with at least one cancer & one cancer free row when the size allows
+        """
+        group_locs = [nonzero(self.init_status == 1)[0], nonzero(self.init_status != 1)[0]]
+        num_follow = self.pool_data[2].shape[0]
+        num_pool = len(self.init_status) + num_follow
+        tasks = []
+        for size in sizes:
+            if size > num_pool:
+                logging.warning("Subsample size %d larger than pool %d - skipped.", size, num_pool)
+                continue
+            num_cancer, num_normal, num_size_follow = get_group_counts(size, [len(group_locs[0]), len(group_locs[1]),
+                                                                              num_follow], num_required=2)
+            for rep in range(num_reps):
+                rng = random.default_rng([base_seed, size, rep])
+                init_locs = concatenate((rng.choice(group_locs[0], num_cancer, replace=False),
+                                         rng.choice(group_locs[1], num_normal, replace=False)))
+                follow_locs = rng.choice(num_follow, num_size_follow, replace=False)
+                tasks.append((size, rep, init_locs, follow_locs))
+        return tasks
+
+
+    def run(self, sizes, num_reps, base_seed, output_prefix, num_workers=1):
+        """
+        fit all subsets in parallel; each result row is written to <prefix>.subsample.tsv as soon as it is done
+        """
+        tasks = self.get_subsample_tasks(sizes, num_reps, base_seed)
+        outfile = open(output_prefix + ".subsample.tsv", 'w')
+        outfile.write('\t'.join(self.result_columns) + '\n')
+        rows = []
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(self.pool_data,)) as pool:
+            jobs = {pool.submit(_fit_subsample, self.config_data, *t): t for t in tasks}
+            for job in as_completed(jobs):
+                try:
+                    row = job.result()
+                except Exception as e: # e.g. a subset the regressor can not fit: keep the other fits
+                    size, rep, init_locs, follow_locs = jobs[job]
+                    logging.warning("Subsample fit of size %d, rep %d failed: %s", size, rep, e)
+                    row = [size, rep, len(init_locs) + len(follow_locs), nan, nan, nan, 0]
+                rows.append(row)
+                outfile.write('\t'.join(str(x) for x in row) + '\n')
+                outfile.flush()
+        outfile.close()
+        logging.info("Finished %d subsample fits.", len(rows))
+
+        summary = self.summarize(DataFrame(rows, columns=self.result_columns))
+        summary.to_csv(output_prefix + ".subsample_summary.tsv", sep='\t', index=False)
+        return summary
+
+
+    def summarize(self, results):
+        """
+        per-size mean, sd and 2.5/50/97.5 percentiles of each metric
+        """
+        summary = results.groupby("size")[["auc", "sens_at_0.95", "sens_at_0.98"]].describe(percentiles=[0.025, 0.5, 0.975])
+        summary.columns = ["_".join(c) for c in summary.columns]
+        summary = summary[[c for c in summary.columns if not c.endswith(("_min", "_max", "_25%", "_75%"))]]
+        return summary.reset_index().round(4)
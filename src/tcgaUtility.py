@@ -0,0 +1,141 @@
+from pandas import read_csv, factorize, Series
+from numpy import zeros, nonzero, isnan, save, load, array, savez, float32, int32
+from scipy.sparse import csr_matrix
+import json
+import os
+
+
+class probeCounts():
+    """
+    region x sample molecule counts of MSRE regions, each row tagged with its 450k probe
+    counts are kept as a single float matrix; probe ids are factorized once so weights are joined by code
+    """
+    def __init__(self, samples, region_ids, probe_ids, counts):
+        self.samples = samples
+        self.region_ids = region_ids
+        self.counts = counts
+        self.probe_codes, self.probe_uniques = factorize(probe_ids) # code -1 for rows without probe
+
+
+    def get_weight_vector(self, probe_weights):
+        """
+        probe_weights: Series of weight indexed by probe id
+        return sparse 1 x region weight row, holding only rows whose probe has a weight
+        """
+        wt_by_code = probe_weights.reindex(self.probe_uniques).values.astype(float)
+        rows = nonzero(self.probe_codes >= 0)[0]
+        row_wts = wt_by_code[self.probe_codes[rows]]
+        keep = ~isnan(row_wts)
+        rows = rows[keep]
+        row_wts = row_wts[keep]
+        return csr_matrix((row_wts, (zeros(len(rows), dtype=int), rows)), shape=(1, self.counts.shape[0]))
+
+
+    def get_weighted_sums(self, weight_rows):
+        """
+        weight_rows: sparse n_weights x region matrix; return n_weights x sample weighted count sums
+        """
+        return weight_rows @ self.counts
+
+
+def load_probe_counts(head_path, data_path, use_cache=True):
+    """
+    data_path is headerless: region_id, samples in head_path order, then probe_450k
+    with use_cache, the parsed table is kept next to data_path as .npy + .index.json and memory-mapped on later loads
+    """
+    matrix_path = data_path + ".counts.npy"
+    index_path = data_path + ".counts.index.json"
+    if use_cache and os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(data_path):
+        infile = open(index_path, 'r')
+        cache_index = json.load(infile)
+        infile.close()
+        counts = load(matrix_path, mmap_mode='r')
+        probe_ids = array([_nan_if_empty(x) for x in cache_index["probes"]], dtype=object)
+        return probeCounts(cache_index["samples"], cache_index["regions"], probe_ids, counts)
+
+    d_head = read_csv(head_path, sep='\t', header=0, nrows=0)
+    colnames = d_head.columns.to_list()
+    samples = colnames[1:]
+    colnames.append("probe_450k")
+
+    dt_msre = read_csv(data_path, sep='\t', header=None, names=colnames)
+    region_ids = dt_msre.pop("region_id").to_list()
+    probe_ids = dt_msre.pop("probe_450k").values
+    counts = dt_msre.to_numpy(dtype=float)
+    if use_cache:
+        save(matrix_path, counts)
+        outfile = open(index_path, 'w')
+        json.dump({"samples": samples, "regions": region_ids,
+                   "probes": ["" if not isinstance(x, str) else x for x in probe_ids]}, outfile)
+        outfile.close()
+    return probeCounts(samples, region_ids, probe_ids, counts)
+
+
+def _nan_if_empty(probe_id):
+    return probe_id if probe_id != "" else float("nan")
+
+
+class tcgaStore():
+    """
+    450k beta values of TCGA projects, one memory-mapped sample x probe matrix per project
+    per-probe tumor prevalence (fraction of tumors with beta > cutoff) is precomputed at standard cutoffs
+    """
+    meta_keys_ = ["sample_id", "sample_type", "percent_tumor_nuclei"]
+    prevalence_cutoffs_ = [0.2, 0.3, 0.5, 0.7]
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_path = os.path.join(store_dir, "index.json")
+        self.projects = {} # project -> number of samples
+        self.probes = None
+        if os.path.exists(self.index_path):
+            infile = open(self.index_path, 'r')
+            store_index = json.load(infile)
+            infile.close()
+            self.projects = store_index["projects"]
+            self.probes = store_index["probes"]
+
+
+    def _project_path(self, pname, suffix):
+        return os.path.join(self.store_dir, pname.upper() + suffix)
+
+
+    @staticmethod
+    def is_tumor(meta):
+        return (meta["sample_type"] == "Primary Tumor") & (meta["percent_tumor_nuclei"] >= 0.5)
+
+
+    def add_project(self, pname, meta_data):
+        """
+        meta_data: one project's frame as in the TCGA feather files (meta keys + one column per probe)
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        if self.probes is None:
+            self.probes = [c for c in meta_data.columns if c not in self.meta_keys_]
+        betas = meta_data.reindex(columns=self.probes).to_numpy(dtype=float32)
+        save(self._project_path(pname, ".betas.npy"), betas)
+        meta_data[self.meta_keys_].to_csv(self._project_path(pname, ".samples.tsv"), sep='\t', index=False)
+
+        # prevalence from full precision values, so cutoff comparisons match the feather data
+        tumor_betas = meta_data[self.is_tumor(meta_data)].reindex(columns=self.probes).to_numpy(dtype=float)
+        num_over = array([(tumor_betas > c).sum(axis=0) for c in self.prevalence_cutoffs_], dtype=int32)
+        savez(self._project_path(pname, ".prevalence.npz"), num_over=num_over, num_tumor=tumor_betas.shape[0])
+
+        self.projects[pname.upper()] = meta_data.shape[0]
+        outfile = open(self.index_path, 'w')
+        json.dump({"projects": self.projects, "probes": self.probes}, outfile)
+        outfile.close()
+
+
+    def get_prevalence(self, project_names, cutoff=0.5):
+        """
+        fraction of tumor samples of the projects with beta > cutoff, per probe
+        """
+        cidx = self.prevalence_cutoffs_.index(cutoff)
+        num_over = zeros(len(self.probes))
+        num_tumor = 0
+        for pname in project_names:
+            prev_data = load(self._project_path(pname, ".prevalence.npz"))
+            num_over += prev_data["num_over"][cidx]
+            num_tumor += int(prev_data["num_tumor"])
+        return Series(num_over / num_tumor, index=self.probes)